@@ -32,12 +32,12 @@ class AudioProcessor:
                 "WHISPER_BACKEND=openai, но пакет 'openai-whisper' не установлен.\n"
                 "Добавьте `openai-whisper==20231117` в requirements.txt или переключитесь на WHISPER_BACKEND=faster."
             ) from e
-        logger.info(f"[whisper(openai)] загрузка модели: {self.model_name}")
+        logger.info("[whisper(openai)] загрузка модели: %s", self.model_name)
         return whisper.load_model(self.model_name)
 
     def _load_faster_whisper(self):
         from faster_whisper import WhisperModel
-        logger.info(f"[whisper(faster)] загрузка модели: {self.model_name} (cpu, int8)")
+        logger.info("[whisper(faster)] загрузка модели: %s (cpu, int8)", self.model_name)
         return WhisperModel(self.model_name, device="cpu", compute_type="int8")
 
     def load_model(self):
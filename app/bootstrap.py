@@ -4,11 +4,20 @@ from app import storage
 
 logger = logging.getLogger(__name__)
 
+_MIGRATIONS_LOCK = "migrations:lock"
+_MIGRATIONS_LOCK_TTL_S = 60
+
+
 def run_startup_migrations():
     """
     Мигрируем PRO_USER_IDS из env в постоянное хранилище (Redis/Postgres).
     Идемпотентно: в Postgres используется ON CONFLICT DO NOTHING, в Redis — set.
+    Параллельные старты (scripts/prestart.py, несколько инстансов) мигрируют один раз:
+    лок migrations:lock в Redis; не снимаем — истечёт сам через минуту.
     """
+    if not storage.acquire_lock(_MIGRATIONS_LOCK, _MIGRATIONS_LOCK_TTL_S):
+        logger.info("ℹ️ Миграции уже выполняет/выполнил другой процесс — пропускаем.")
+        return
     try:
         if PRO_USER_IDS:
             migrated = 0
@@ -17,9 +26,9 @@ def run_startup_migrations():
                     storage.add_pro(int(uid))
                     migrated += 1
                 except Exception as e:
-                    logger.warning(f"Не удалось мигрировать user_id={uid}: {e}")
-            logger.info(f"✅ Миграция PRO_USER_IDS завершена. Перенесено: {migrated}")
+                    logger.warning("Не удалось мигрировать user_id=%s: %s", uid, e)
+            logger.info("✅ Миграция PRO_USER_IDS завершена. Перенесено: %s", migrated)
         else:
             logger.info("ℹ️ PRO_USER_IDS не задан — миграция не требуется.")
     except Exception as e:
-        logger.warning(f"⚠️ Ошибка миграции PRO_USER_IDS: {e}")
+        logger.warning("⚠️ Ошибка миграции PRO_USER_IDS: %s", e)
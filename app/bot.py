@@ -725,7 +725,7 @@ async def process_via_queue(update: Update, context: ContextTypes.DEFAULT_TYPE,
                                         caption="📄 PDF версия",
                                     )
                             except Exception as e:
-                                logger.error(f"Ошибка отправки PDF: {e}")
+                                logger.error("Ошибка отправки PDF: %s", e)
                     else:
                         await update.message.reply_text(head + "\n\n" + "📝 Результат:\n\n" + text)
 
@@ -816,7 +816,7 @@ async def process_via_queue(update: Update, context: ContextTypes.DEFAULT_TYPE,
                     f"Приоритет: {_priority_badge(is_pro)}"
                 )
     except Exception as e:
-        logger.error(f"Ошибка очереди: {e}")
+        logger.error("Ошибка очереди: %s", e)
         await queue_msg.edit_text("❌ Системная ошибка.")
 
 # ---------- Экспорт по кнопкам ----------
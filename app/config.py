@@ -83,6 +83,10 @@ STREAM_TIMEOUT_S = _env_int("STREAM_TIMEOUT_S", 45)
 RESUME_DOWNLOADS = _env_int("RESUME_DOWNLOADS", 1)
 YTDLP_AUDIO_ONLY = _env_int("YTDLP_AUDIO_ONLY", 1)
 
+# === Перевод ===
+TR_CONCURRENCY = _env_int("TR_CONCURRENCY", 4)  # параллельных запросов к переводчику
+TR_DETECT = _env_bool("TR_DETECT", False)  # не переводить куски, уже написанные на целевом языке (lingua)
+
 # === Диаризация (опционально) ===
 DIARIZATION_BACKEND = _env_str("DIARIZATION_BACKEND", "none")  # "pyannote" | "none"
 HUGGINGFACE_TOKEN = _env_str("HUGGINGFACE_TOKEN", "")
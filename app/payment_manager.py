@@ -2,18 +2,21 @@
 import logging
 import hmac
 import hashlib
-from typing import Dict, Optional, Any
+from typing import Dict, Optional, Any, Mapping
 from urllib.parse import urlencode, urlparse, parse_qsl, urlunparse
 
 from app import storage
 
 logger = logging.getLogger(__name__)
 
+_SIG_HEX_LEN = hashlib.sha256().digest_size * 2  # 64 hex-символа
+
 
 class PaymentManager:
     """
     Prodamus:
-      - verify_webhook_signature(raw_payload, headers) -> bool
+      - verify_webhook_signature(raw_payload, headers: Mapping) -> bool
+      - signature_error(raw_payload, headers: Mapping) -> Optional[str] (причина отказа для метрик)
       - get_payment_url(user_id, amount?)
       - get_topup_url(user_id, minutes, amount)
       - handle_webhook(payload) -> Dict (idempotent)
@@ -33,14 +36,15 @@ class PaymentManager:
 
     # ----------------- helpers -----------------
 
-    def _extract_signature(self, headers: Dict[str, str]) -> Optional[str]:
+    def _extract_signature(self, headers: Mapping[str, str]) -> Optional[str]:
         if not headers:
             return None
-        # прямое имя
+        # прямое имя (Werkzeug EnvironHeaders сам ищет без учёта регистра)
         for k in self.SIGNATURE_HEADER_CANDIDATES:
-            if k in headers:
-                return headers.get(k)
-        # без учёта регистра
+            v = headers.get(k)
+            if v:
+                return v
+        # без учёта регистра — для обычного dict
         lower = {k.lower(): v for k, v in headers.items()}
         for k in self.SIGNATURE_HEADER_CANDIDATES:
             v = lower.get(k.lower())
@@ -120,18 +124,33 @@ class PaymentManager:
 
     # ----------------- public API -----------------
 
-    def verify_webhook_signature(self, raw_payload: bytes, headers: Dict[str, str]) -> bool:
-        """HMAC-SHA256 по «сырым» байтам тела запроса. Возвращает True/False."""
+    def signature_error(self, raw_payload: bytes, headers: Mapping[str, str]) -> Optional[str]:
+        """
+        HMAC-SHA256 по «сырым» байтам тела запроса.
+        None — подпись верна; иначе причина: no_signature / bad_sig_length / bad_signature / sig_error.
+        Подпись не той длины отбрасываем до хэширования тела.
+        """
         try:
             sig = self._extract_signature(headers)
             if not sig:
                 logger.warning("Prodamus: подпись отсутствует")
-                return False
-            expected = hmac.new(self.webhook_secret, raw_payload, hashlib.sha256).hexdigest()
-            return hmac.compare_digest(expected, self._normalize_signature(sig))
+                return "no_signature"
+            sig = self._normalize_signature(sig)
+            if len(sig) != _SIG_HEX_LEN:
+                return "bad_sig_length"
+            try:
+                got = bytes.fromhex(sig)
+            except ValueError:
+                return "bad_signature"
+            expected = hmac.new(self.webhook_secret, raw_payload, hashlib.sha256).digest()
+            return None if hmac.compare_digest(expected, got) else "bad_signature"
         except Exception as e:
             logger.error("Prodamus: ошибка проверки подписи: %s", e)
-            return False
+            return "sig_error"
+
+    def verify_webhook_signature(self, raw_payload: bytes, headers: Mapping[str, str]) -> bool:
+        """HMAC-SHA256 по «сырым» байтам тела запроса. Возвращает True/False."""
+        return self.signature_error(raw_payload, headers) is None
 
     # === PRO ===
     def get_payment_url(self, user_id: int, amount: Optional[float] = None) -> str:
@@ -164,6 +183,8 @@ class PaymentManager:
           • type: pro/topup
           • minutes (для topup)
         """
+        payment_id = ""
+        claimed = granted = False
         try:
             user_id = self._extract_user_id(payload)
             if not user_id:
@@ -183,9 +204,11 @@ class PaymentManager:
             minutes = self._extract_minutes(payload)
 
             payment_id = self._extract_payment_id(payload) or ""
-            if payment_id and storage.is_payment_processed("prodamus", payment_id):
+            # атомарный claim вместо «проверить, потом пометить»: ретраи не начислят дважды
+            if payment_id and not storage.claim_payment("prodamus", payment_id):
                 logger.info("Prodamus: duplicate webhook ignored (%s)", payment_id)
                 return {"success": True, "message": "already processed"}
+            claimed = bool(payment_id)
 
             # Расширенная эвристика «оплачен»
             paid = (
@@ -195,16 +218,16 @@ class PaymentManager:
             )
 
             if paid:
-                if payment_id:
-                    storage.mark_payment_processed("prodamus", payment_id)
-
+                # отметка «обработан» и начисление — одной записью в хранилище
                 if pay_type == "topup" and minutes > 0:
-                    storage.add_overage_seconds(user_id, minutes * 60)
+                    storage.apply_grant("prodamus", payment_id, user_id, "topup", minutes * 60)
+                    granted = True
                     logger.info("Prodamus: user %s TOPUP +%sm (payment_id=%s)", user_id, minutes, payment_id)
                     return {"success": True, "message": f"user {user_id} topped up {minutes}m"}
 
                 # по умолчанию — PRO
-                storage.add_pro(user_id)
+                storage.apply_grant("prodamus", payment_id, user_id, "pro")
+                granted = True
                 logger.info("Prodamus: user %s upgraded to PRO (payment_id=%s)", user_id, payment_id)
                 return {"success": True, "message": f"user {user_id} upgraded to PRO"}
 
@@ -218,3 +241,6 @@ class PaymentManager:
         except Exception as e:
             logger.exception("Prodamus webhook error")
             return {"success": False, "error": str(e)}
+        finally:
+            if claimed and not granted:
+                storage.release_payment_claim("prodamus", payment_id)
@@ -1,11 +1,17 @@
 # app/storage.py
 import os
 import logging
+import socket
+import threading
+import time
+import uuid
 from typing import Optional, Tuple, Dict, Set
 from datetime import date, datetime, timedelta
 import random
 import string
 
+import orjson
+
 from app.config import REDIS_URL, DATABASE_URL
 
 logger = logging.getLogger(__name__)
@@ -19,9 +25,18 @@ if REDIS_URL:
         _redis.ping()
         logger.info("✅ Redis подключен")
     except Exception as e:
-        logger.warning(f"⚠️ Redis недоступен: {e}")
+        logger.warning("⚠️ Redis недоступен: %s", e)
         _redis = None
 
+# Lua-скрипты Redis: регистрируются лениво, дальше — EVALSHA по кэшу
+_scripts: Dict[str, object] = {}
+
+def _get_script(lua: str):
+    script = _scripts.get(lua)
+    if script is None:
+        script = _scripts[lua] = _redis.register_script(lua)
+    return script
+
 # ---- Postgres (опционально) ----
 _pg_conn = None
 if DATABASE_URL:
@@ -61,6 +76,16 @@ if DATABASE_URL:
               PRIMARY KEY (provider, payment_id)
             );
             """)
+            # Платежи в обработке (claim_payment): короткая блокировка с истечением,
+            # в processed_payments попадают только начисленные
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS payment_claims (
+              provider TEXT NOT NULL,
+              payment_id TEXT NOT NULL,
+              expires_at TIMESTAMPTZ NOT NULL,
+              PRIMARY KEY (provider, payment_id)
+            );
+            """)
             # Реферальные коды
             cur.execute("""
             CREATE TABLE IF NOT EXISTS referral_codes (
@@ -97,7 +122,7 @@ if DATABASE_URL:
             """)
         logger.info("✅ Postgres подключен, таблицы готовы")
     except Exception as e:
-        logger.warning(f"⚠️ Postgres недоступен: {e}")
+        logger.warning("⚠️ Postgres недоступен: %s", e)
         _pg_conn = None
 
 # ---- Memory fallback ----
@@ -107,8 +132,12 @@ _mem_usage: Dict[int, Tuple[int, date]] = {}
 _mem_pro: Set[int] = set()
 # user_overage: докупленные секунды на сегодня
 _mem_overage: Dict[int, Tuple[int, date]] = {}
+_mem_overage_lock = threading.Lock()
 # processed_payments: идемпотентность платежей
 _mem_processed: Set[Tuple[str, str]] = set()
+# claim_payment: платежи в обработке -> monotonic-время истечения claim
+_mem_claims: Dict[Tuple[str, str], float] = {}
+_mem_claims_lock = threading.Lock()
 
 # Временный PRO (pro_until)
 _mem_pro_until: Dict[int, date] = {}
@@ -154,7 +183,7 @@ def get_usage(user_id: int) -> Tuple[int, date]:
                 if row:
                     return int(row[0]), row[1]
         except Exception as e:
-            logger.debug(f"Postgres get_usage error: {e}")
+            logger.debug("Postgres get_usage error: %s", e)
 
     # Memory
     if user_id in _mem_usage:
@@ -196,7 +225,7 @@ def set_usage(user_id: int, used_seconds: int, last_reset_date: date):
                     (user_id, int(used_seconds), last_reset_date),
                 )
         except Exception as e:
-            logger.debug(f"Postgres set_usage error: {e}")
+            logger.debug("Postgres set_usage error: %s", e)
 
     # Memory
     _mem_usage[user_id] = (int(used_seconds), last_reset_date)
@@ -223,7 +252,7 @@ def get_pro_until(user_id: int) -> Optional[date]:
                 if row:
                     return row[0]
         except Exception as e:
-            logger.debug(f"Postgres get_pro_until error: {e}")
+            logger.debug("Postgres get_pro_until error: %s", e)
     # Memory
     return _mem_pro_until.get(user_id)
 
@@ -254,7 +283,7 @@ def add_pro_for_days(user_id: int, days: int) -> None:
                       until_date = GREATEST(pro_until.until_date, EXCLUDED.until_date)
                 """, (user_id, new_until))
         except Exception as e:
-            logger.debug(f"Postgres add_pro_for_days error: {e}")
+            logger.debug("Postgres add_pro_for_days error: %s", e)
 
     # Memory
     _mem_pro_until[user_id] = new_until
@@ -283,7 +312,7 @@ def is_pro(user_id: int) -> bool:
                 cur.execute("SELECT 1 FROM pro_users WHERE user_id=%s", (user_id,))
                 perm = cur.fetchone() is not None
         except Exception as e:
-            logger.debug(f"Postgres is_pro permanent error: {e}")
+            logger.debug("Postgres is_pro permanent error: %s", e)
     if not perm:
         perm = user_id in _mem_pro
     if perm:
@@ -309,7 +338,7 @@ def add_pro(user_id: int):
                     (user_id,),
                 )
         except Exception as e:
-            logger.debug(f"Postgres add_pro error: {e}")
+            logger.debug("Postgres add_pro error: %s", e)
     # Memory
     _mem_pro.add(user_id)
 
@@ -324,7 +353,7 @@ def remove_pro(user_id: int):
             with _pg_conn.cursor() as cur:
                 cur.execute("DELETE FROM pro_users WHERE user_id=%s", (user_id,))
         except Exception as e:
-            logger.debug(f"Postgres remove_pro error: {e}")
+            logger.debug("Postgres remove_pro error: %s", e)
     _mem_pro.discard(user_id)
 
 def count_pro() -> int:
@@ -340,7 +369,7 @@ def count_pro() -> int:
                 (cnt,) = cur.fetchone()
                 return int(cnt)
         except Exception as e:
-            logger.debug(f"Postgres count_pro error: {e}")
+            logger.debug("Postgres count_pro error: %s", e)
     return len(_mem_pro)
 
 # ============================================================
@@ -374,7 +403,7 @@ def get_overage(user_id: int) -> Tuple[int, date]:
                 if row:
                     return int(row[0]), row[1]
         except Exception as e:
-            logger.debug(f"Postgres get_overage error: {e}")
+            logger.debug("Postgres get_overage error: %s", e)
 
     # Memory
     if user_id in _mem_overage:
@@ -415,7 +444,7 @@ def set_overage(user_id: int, extra_seconds: int, last_reset_date: date):
                     (user_id, int(extra_seconds), last_reset_date),
                 )
         except Exception as e:
-            logger.debug(f"Postgres set_overage error: {e}")
+            logger.debug("Postgres set_overage error: %s", e)
 
     # Memory
     _mem_overage[user_id] = (int(extra_seconds), last_reset_date)
@@ -461,7 +490,7 @@ def is_payment_processed(provider: str, payment_id: str) -> bool:
                 )
                 return cur.fetchone() is not None
         except Exception as e:
-            logger.debug(f"Postgres is_payment_processed error: {e}")
+            logger.debug("Postgres is_payment_processed error: %s", e)
 
     # Memory
     return (provider, payment_id) in _mem_processed
@@ -492,11 +521,384 @@ def mark_payment_processed(provider: str, payment_id: str):
                     (provider, payment_id),
                 )
         except Exception as e:
-            logger.debug(f"Postgres mark_payment_processed error: {e}")
+            logger.debug("Postgres mark_payment_processed error: %s", e)
 
     # Memory
     _mem_processed.add((provider, payment_id))
 
+# Докупка в Redis: прибавить к сегодняшним секундам или начать день заново — атомарно,
+# чтобы параллельные начисления одному пользователю не затирали друг друга.
+_TOPUP_LUA = """
+if redis.call('HGET', KEYS[1], 'last_reset_date') == ARGV[2] then
+  redis.call('HINCRBY', KEYS[1], 'extra_seconds', ARGV[1])
+else
+  redis.call('HSET', KEYS[1], 'extra_seconds', ARGV[1], 'last_reset_date', ARGV[2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+def apply_grant(provider: str, payment_id: str, user_id: int, kind: str, seconds: Optional[int] = None):
+    """
+    Начисление по оплате одним заходом в хранилище: отметка processed_payments
+    (и снятие claim_payment) + PRO (kind="pro") или докупка seconds на сегодня (kind="topup").
+    Redis — одна транзакция-пайплайн, Postgres — одна транзакция.
+    """
+    if kind not in ("pro", "topup"):
+        raise ValueError(f"unknown grant kind: {kind}")
+    add_seconds = max(0, int(seconds or 0))
+    today = date.today()
+
+    # Redis
+    if _redis:
+        try:
+            with _redis.pipeline(transaction=True) as pipe:
+                if payment_id:
+                    pipe.sadd(f"pp:{provider}", payment_id)
+                    pipe.expire(f"pp:{provider}", 60 * 60 * 24 * 90)  # 90 дней
+                    pipe.delete(f"pc:{provider}:{payment_id}")
+                if kind == "pro":
+                    pipe.sadd("pro_users", user_id)
+                else:
+                    _get_script(_TOPUP_LUA)(
+                        keys=[f"overage:{user_id}"],
+                        args=[add_seconds, today.isoformat(), 60 * 60 * 24 * 3],
+                        client=pipe,
+                    )
+                pipe.execute()
+        except Exception as e:
+            logger.debug("Redis apply_grant error: %s", e)
+
+    # Postgres
+    if _pg_conn:
+        try:
+            with _pg_conn.transaction(), _pg_conn.cursor() as cur:
+                if payment_id:
+                    cur.execute(
+                        """
+                        INSERT INTO processed_payments (provider, payment_id)
+                        VALUES (%s, %s)
+                        ON CONFLICT (provider, payment_id) DO NOTHING
+                        """,
+                        (provider, payment_id),
+                    )
+                    cur.execute(
+                        "DELETE FROM payment_claims WHERE provider=%s AND payment_id=%s",
+                        (provider, payment_id),
+                    )
+                if kind == "pro":
+                    cur.execute(
+                        "INSERT INTO pro_users (user_id) VALUES (%s) ON CONFLICT DO NOTHING",
+                        (user_id,),
+                    )
+                else:
+                    cur.execute(
+                        """
+                        INSERT INTO user_overage (user_id, extra_seconds, last_reset_date)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (user_id) DO UPDATE SET
+                            extra_seconds = CASE
+                                WHEN user_overage.last_reset_date = EXCLUDED.last_reset_date
+                                THEN user_overage.extra_seconds + EXCLUDED.extra_seconds
+                                ELSE EXCLUDED.extra_seconds
+                            END,
+                            last_reset_date = EXCLUDED.last_reset_date
+                        """,
+                        (user_id, add_seconds, today),
+                    )
+        except Exception as e:
+            logger.debug("Postgres apply_grant error: %s", e)
+
+    # Memory
+    if payment_id:
+        _mem_processed.add((provider, payment_id))
+        with _mem_claims_lock:
+            _mem_claims.pop((provider, payment_id), None)
+    if kind == "pro":
+        _mem_pro.add(user_id)
+    else:
+        with _mem_overage_lock:
+            cur_extra, last = _mem_overage.get(user_id, (0, today))
+            _mem_overage[user_id] = ((cur_extra if last == today else 0) + add_seconds, today)
+
+# claim — короткая «блокировка на время обработки», а не отметка «обработан» (это pp:/processed_payments).
+# TTL меньше аренды воркера очереди (120 с): если процесс умер между claim и apply_grant,
+# к моменту повторной выдачи задания claim уже истёк и начисление не теряется.
+PAYMENT_CLAIM_TTL_S = 60
+
+# claim в Redis: платёж уже в pp:{provider} — не занимаем; иначе SET NX EX.
+# Одним скриптом, чтобы между проверкой и SET никто не вклинился.
+_CLAIM_LUA = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then return 0 end
+if redis.call('SET', KEYS[2], '1', 'NX', 'EX', ARGV[2]) then return 1 end
+return 0
+"""
+
+def claim_payment(provider: str, payment_id: str, ttl: int = PAYMENT_CLAIM_TTL_S) -> bool:
+    """
+    Атомарно «занять» платёж на ttl сек. перед начислением: True — обрабатываем мы,
+    False — он уже обработан или его прямо сейчас обрабатывает другой вебхук (ретрай провайдера).
+    После начисления claim снимает apply_grant; если начисления не было — release_payment_claim.
+    """
+    if not provider or not payment_id:
+        return True
+
+    # Redis
+    if _redis:
+        try:
+            keys = [f"pp:{provider}", f"pc:{provider}:{payment_id}"]
+            return bool(_get_script(_CLAIM_LUA)(keys=keys, args=[payment_id, int(ttl)]))
+        except Exception as e:
+            logger.debug("Redis claim_payment error: %s", e)
+
+    # Postgres
+    if _pg_conn:
+        try:
+            with _pg_conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO payment_claims (provider, payment_id, expires_at)
+                    SELECT %s, %s, NOW() + make_interval(secs => %s)
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM processed_payments WHERE provider=%s AND payment_id=%s
+                    )
+                    ON CONFLICT (provider, payment_id) DO UPDATE SET expires_at = EXCLUDED.expires_at
+                    WHERE payment_claims.expires_at < NOW()
+                    RETURNING 1
+                    """,
+                    (provider, payment_id, int(ttl), provider, payment_id),
+                )
+                return cur.fetchone() is not None
+        except Exception as e:
+            logger.debug("Postgres claim_payment error: %s", e)
+
+    # Memory
+    key = (provider, payment_id)
+    now = time.monotonic()
+    with _mem_claims_lock:
+        if key in _mem_processed or _mem_claims.get(key, 0.0) > now:
+            return False
+        _mem_claims[key] = now + int(ttl)
+        return True
+
+def release_payment_claim(provider: str, payment_id: str):
+    if not provider or not payment_id:
+        return
+
+    # Redis
+    if _redis:
+        try:
+            _redis.delete(f"pc:{provider}:{payment_id}")
+            return
+        except Exception as e:
+            logger.debug("Redis release_payment_claim error: %s", e)
+
+    # Postgres
+    if _pg_conn:
+        try:
+            with _pg_conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM payment_claims WHERE provider=%s AND payment_id=%s",
+                    (provider, payment_id),
+                )
+            return
+        except Exception as e:
+            logger.debug("Postgres release_payment_claim error: %s", e)
+
+    # Memory
+    with _mem_claims_lock:
+        _mem_claims.pop((provider, payment_id), None)
+
+# ============================================================
+#                     МЕЖПРОЦЕССНЫЕ ЛОКИ
+# ============================================================
+
+def acquire_lock(name: str, ttl: int = 60) -> bool:
+    """
+    Best-effort лок между процессами/инстансами: Redis SET NX EX.
+    Без Redis (или при его ошибке) — True: координировать некого, память у каждого процесса своя.
+    """
+    if _redis:
+        try:
+            return bool(_redis.set(name, os.getpid(), nx=True, ex=int(ttl)))
+        except Exception as e:
+            logger.debug("Redis acquire_lock error: %s", e)
+    return True
+
+# ============================================================
+#                     ОЧЕРЕДЬ ВЕБХУКОВ
+# ============================================================
+# Только Redis (без него вебхук обрабатывается сразу, см. app/web.py).
+# LPUSH в wh:jobs, воркер забирает BRPOPLPUSH в свой wh:jobs:processing:{consumer}
+# и удаляет оттуда после обработки (ack). Живость потребителя — ключ-аренда wh:jobs:lease:{consumer};
+# задания потребителя с истёкшей арендой возвращаются в очередь (requeue_stale_webhook_jobs).
+# Повторы с задержкой — ZSET wh:jobs:delayed (score = время, когда пора), переносит promote_due_webhook_jobs.
+# Исчерпавшие все повторы — в wh:jobs:dead (вернуть вручную: redrive_dead_webhook_jobs).
+
+_WEBHOOK_JOBS_KEY = "wh:jobs"
+_WEBHOOK_JOBS_DELAYED_KEY = "wh:jobs:delayed"
+_WEBHOOK_JOBS_DEAD_KEY = "wh:jobs:dead"
+_WEBHOOK_CONSUMERS_KEY = "wh:jobs:consumers"
+_WEBHOOK_LEASE_S = 120
+
+# Созревшие отложенные задания -> в очередь, атомарно (не больше ARGV[2] за вызов)
+_PROMOTE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, raw in ipairs(due) do
+  redis.call('ZREM', KEYS[1], raw)
+  redis.call('LPUSH', KEYS[2], raw)
+end
+return #due
+"""
+
+_webhook_consumer: Optional[Tuple[int, str]] = None  # (pid, id): после fork id новый
+
+def _consumer_id() -> str:
+    global _webhook_consumer
+    pid = os.getpid()
+    if _webhook_consumer is None or _webhook_consumer[0] != pid:
+        _webhook_consumer = (pid, f"{socket.gethostname()}:{pid}:{uuid.uuid4().hex[:8]}")
+    return _webhook_consumer[1]
+
+def _processing_key(consumer: str) -> str:
+    return f"{_WEBHOOK_JOBS_KEY}:processing:{consumer}"
+
+def _lease_key(consumer: str) -> str:
+    return f"{_WEBHOOK_JOBS_KEY}:lease:{consumer}"
+
+def _webhook_job_raw(provider: str, payload: Dict, attempt: int) -> str:
+    return orjson.dumps({"provider": provider, "payload": payload, "attempt": int(attempt)}).decode()
+
+def has_webhook_queue() -> bool:
+    """Есть ли очередь вебхуков (Redis): она переживает рестарт процесса."""
+    return _redis is not None
+
+def enqueue_webhook_job(provider: str, payload: Dict, attempt: int = 0, delay: float = 0) -> bool:
+    """
+    Поставить задание (delay > 0 — не раньше чем через delay сек.).
+    False — Redis нет или он недоступен: задание НЕ поставлено.
+    """
+    if not _redis:
+        return False
+    raw = _webhook_job_raw(provider, payload, attempt)
+    try:
+        if delay > 0:
+            _redis.zadd(_WEBHOOK_JOBS_DELAYED_KEY, {raw: time.time() + delay})
+        else:
+            _redis.lpush(_WEBHOOK_JOBS_KEY, raw)
+        return True
+    except Exception as e:
+        logger.warning("Redis enqueue_webhook_job error: %s", e)
+        return False
+
+def promote_due_webhook_jobs(limit: int = 100) -> int:
+    """Отложенные задания, у которых подошло время, — в очередь."""
+    if not _redis:
+        return 0
+    try:
+        return int(_get_script(_PROMOTE_LUA)(
+            keys=[_WEBHOOK_JOBS_DELAYED_KEY, _WEBHOOK_JOBS_KEY],
+            args=[time.time(), int(limit)],
+        ))
+    except Exception as e:
+        logger.debug("Redis promote_due_webhook_jobs error: %s", e)
+        return 0
+
+def renew_webhook_lease(ttl: int = _WEBHOOK_LEASE_S) -> None:
+    """Продлить аренду текущего потребителя; вызывать чаще, чем раз в ttl сек."""
+    if not _redis:
+        return
+    consumer = _consumer_id()
+    try:
+        with _redis.pipeline(transaction=False) as pipe:
+            pipe.sadd(_WEBHOOK_CONSUMERS_KEY, consumer)
+            pipe.set(_lease_key(consumer), "1", ex=int(ttl))
+            pipe.execute()
+    except Exception as e:
+        logger.debug("Redis renew_webhook_lease error: %s", e)
+
+def take_webhook_job(timeout: int = 5) -> Optional[Tuple[str, Dict]]:
+    """
+    Ждёт задание до timeout сек. (raw, job) или None; raw передать в ack_webhook_job.
+    При ошибке Redis — пауза timeout сек., чтобы цикл воркера не крутился вхолостую.
+    """
+    if not _redis:
+        time.sleep(timeout)
+        return None
+    try:
+        raw = _redis.brpoplpush(_WEBHOOK_JOBS_KEY, _processing_key(_consumer_id()), timeout=timeout)
+    except Exception as e:
+        logger.debug("Redis take_webhook_job error: %s", e)
+        time.sleep(timeout)
+        return None
+    if raw is None:
+        return None
+    try:
+        return raw, orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        logger.warning("Dropping malformed webhook job")
+        ack_webhook_job(raw)
+        return None
+
+def ack_webhook_job(raw: str) -> None:
+    if _redis:
+        try:
+            _redis.lrem(_processing_key(_consumer_id()), 1, raw)
+        except Exception:
+            pass
+
+def bury_webhook_job(provider: str, payload: Dict, attempt: int) -> bool:
+    """Задание, исчерпавшее все повторы, — в dead-letter; False — не удалось (не подтверждать!)."""
+    if not _redis:
+        return False
+    try:
+        _redis.lpush(_WEBHOOK_JOBS_DEAD_KEY, _webhook_job_raw(provider, payload, attempt))
+        return True
+    except Exception as e:
+        logger.warning("Redis bury_webhook_job error: %s", e)
+        return False
+
+def redrive_dead_webhook_jobs() -> int:
+    """
+    Вручную вернуть dead-letter в очередь (после починки причины), например:
+    python -c "from app import storage; print(storage.redrive_dead_webhook_jobs())"
+    """
+    if not _redis:
+        return 0
+    n = 0
+    try:
+        while _redis.rpoplpush(_WEBHOOK_JOBS_DEAD_KEY, _WEBHOOK_JOBS_KEY):
+            n += 1
+    except Exception as e:
+        logger.debug("Redis redrive_dead_webhook_jobs error: %s", e)
+    return n
+
+def requeue_stale_webhook_jobs() -> int:
+    """
+    Неподтверждённые задания — обратно в очередь: потребителей с истёкшей арендой
+    (рестарт/падение посреди обработки) и свои собственные. Вызывать из потока-потребителя
+    между заданиями: потребитель в процессе один, так что всё в своём processing-списке
+    в этот момент — задания, которые не удалось подтвердить (например, Redis отвалился).
+    Чужие задания у живых воркеров не трогаем.
+    """
+    if not _redis:
+        return 0
+    n = 0
+    me = _consumer_id()
+    try:
+        dead = [
+            c for c in _redis.smembers(_WEBHOOK_CONSUMERS_KEY)
+            if c != me and not _redis.exists(_lease_key(c))
+        ]
+        for consumer in [me] + dead:
+            while _redis.rpoplpush(_processing_key(consumer), _WEBHOOK_JOBS_KEY):
+                n += 1
+        if dead:
+            _redis.srem(_WEBHOOK_CONSUMERS_KEY, *dead)
+    except Exception as e:
+        logger.debug("Redis requeue_stale_webhook_jobs error: %s", e)
+    return n
+
 # ============================================================
 #                      РЕФЕРАЛЬНАЯ ПРОГРАММА
 # ============================================================
@@ -547,7 +949,7 @@ def get_or_create_ref_code(user_id: int) -> str:
                 _mem_user_by_ref_code[code] = user_id
                 return code
         except Exception as e:
-            logger.debug(f"Postgres get_or_create_ref_code error: {e}")
+            logger.debug("Postgres get_or_create_ref_code error: %s", e)
 
     # Memory
     if user_id in _mem_ref_code_by_user:
@@ -581,7 +983,7 @@ def resolve_ref_code(code: str) -> Optional[int]:
                 if row:
                     return int(row[0])
         except Exception as e:
-            logger.debug(f"Postgres resolve_ref_code error: {e}")
+            logger.debug("Postgres resolve_ref_code error: %s", e)
     # Memory
     return _mem_user_by_ref_code.get(code)
 
@@ -607,7 +1009,7 @@ def bind_referral(referrer_id: int, referred_id: int) -> bool:
                 )
                 inserted = cur.rowcount > 0
         except Exception as e:
-            logger.debug(f"Postgres bind_referral error: {e}")
+            logger.debug("Postgres bind_referral error: %s", e)
 
     # Memory (если не вставилось в БД)
     if not inserted:
@@ -643,7 +1045,7 @@ def get_referrer(referred_id: int) -> Optional[int]:
                 if row:
                     return int(row[0])
         except Exception as e:
-            logger.debug(f"Postgres get_referrer error: {e}")
+            logger.debug("Postgres get_referrer error: %s", e)
     # Memory
     if referred_id in _mem_referrals:
         return _mem_referrals[referred_id][0]
@@ -667,7 +1069,7 @@ def has_first_reward(referred_id: int) -> bool:
                 if row:
                     return bool(row[0])
         except Exception as e:
-            logger.debug(f"Postgres has_first_reward error: {e}")
+            logger.debug("Postgres has_first_reward error: %s", e)
     # Memory
     if referred_id in _mem_referrals:
         return bool(_mem_referrals[referred_id][1])
@@ -690,7 +1092,7 @@ def mark_referral_rewarded(referred_id: int) -> None:
                     (today, referred_id),
                 )
         except Exception as e:
-            logger.debug(f"Postgres mark_referral_rewarded error: {e}")
+            logger.debug("Postgres mark_referral_rewarded error: %s", e)
     # Memory
     if referred_id in _mem_referrals:
         ref_id, _, _ = _mem_referrals[referred_id]
@@ -709,7 +1111,7 @@ def get_today_rewarded_count(referrer_id: int) -> int:
                 (cnt,) = cur.fetchone()
                 return int(cnt)
         except Exception as e:
-            logger.debug(f"Postgres get_today_rewarded_count error: {e}")
+            logger.debug("Postgres get_today_rewarded_count error: %s", e)
     # Memory/Redis (best-effort)
     cnt = 0
     for _, (ref_id, rewarded, dt) in _mem_referrals.items():
@@ -731,7 +1133,7 @@ def get_ref_stats(user_id: int) -> Dict[str, int]:
                 (rewarded,) = cur.fetchone()
                 return {"total": int(total), "rewarded": int(rewarded)}
         except Exception as e:
-            logger.debug(f"Postgres get_ref_stats error: {e}")
+            logger.debug("Postgres get_ref_stats error: %s", e)
     # Memory
     for _, (ref_id, rew, _) in _mem_referrals.items():
         if ref_id == user_id:
@@ -759,7 +1161,7 @@ def is_tier_awarded(user_id: int, tier: int) -> bool:
                 )
                 return cur.fetchone() is not None
         except Exception as e:
-            logger.debug(f"Postgres is_tier_awarded error: {e}")
+            logger.debug("Postgres is_tier_awarded error: %s", e)
     # Memory
     return int(tier) in _mem_ref_tier_awarded.get(user_id, set())
 
@@ -780,7 +1182,7 @@ def mark_tier_awarded(user_id: int, tier: int) -> None:
                     (user_id, int(tier)),
                 )
         except Exception as e:
-            logger.debug(f"Postgres mark_tier_awarded error: {e}")
+            logger.debug("Postgres mark_tier_awarded error: %s", e)
     # Memory
     s = _mem_ref_tier_awarded.setdefault(user_id, set())
     s.add(int(tier))
@@ -2,11 +2,12 @@
 from __future__ import annotations
 
 import asyncio
+import contextvars
 import os
 import logging
 import time
-import uuid
-from dataclasses import dataclass, field
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
 from typing import Callable, Any, Dict, Tuple, Optional, List
 
@@ -25,20 +26,26 @@ _QUEUE_SIZE = Gauge("taskqueue_queue_size", "Current queued tasks")
 _ACTIVE_TASKS = Gauge("taskqueue_active_tasks", "Current active tasks")
 _TASK_DURATION = Summary("taskqueue_task_duration_seconds", "Task execution time (wall clock)")
 
-@dataclass(order=True)
+# Поля task_results с метками времени (float time.time())
+_TS_KEYS = ("created_at", "started_at", "completed_at")
+
+# Префикс ID на процесс: ID из кнопок «Отменить» не совпадут с задачами после рестарта
+_ID_PREFIX = os.urandom(4).hex()
+
+# Общие пустые контейнеры для задач без доп. аргументов (не аллоцируем на каждую задачу)
+_EMPTY_ARGS: Tuple = ()
+_EMPTY_KWARGS: Dict = {}
+
+@dataclass(slots=True)
 class _PQItem:
     """
-    Элемент очереди (min-heap) с сортировкой по: (prio, created_ts, seq).
-    Меньший prio -> выше приоритет (например, PRO=0).
+    Элемент очереди. Порядок задаёт сама очередь (_hi/_lo, FIFO внутри каждой).
     """
-    prio: int
-    created_ts: float
-    seq: int
-    id: str = field(compare=False)
-    func: Callable = field(compare=False)
-    args: Tuple = field(compare=False)
-    kwargs: Dict = field(compare=False)
-    timeout: Optional[float] = field(default=None, compare=False)  # сек, опционально
+    id: str
+    func: Callable
+    args: Tuple
+    kwargs: Dict
+    timeout: Optional[float] = None  # сек, опционально
 
 
 class TaskQueue:
@@ -58,16 +65,22 @@ class TaskQueue:
     def __init__(self, max_concurrent_tasks: int = 3):
         self.max_concurrent_tasks = max_concurrent_tasks
 
-        # приоритетная куча + блокировка
-        self._heap: List[_PQItem] = []
-        self._heap_lock = asyncio.Lock()
-        self._seq = 0
+        # Приоритет на практике бинарный: _hi (PRO/админ, prio<=0) и _lo (обычные).
+        # Внутри каждой — FIFO; _hi всегда разбирается первой.
+        self._hi: deque[_PQItem] = deque()
+        self._lo: deque[_PQItem] = deque()
+        self._queue_cond = asyncio.Condition()
+        self._id_counter = 0
 
+        # task_id -> воркер, который сейчас выполняет задачу (для cancel)
         self.active_tasks: Dict[str, asyncio.Task] = {}
         self.task_results: Dict[str, Dict[str, Any]] = {}
 
         self._is_running = False
-        self._worker_task: Optional[asyncio.Task] = None
+        # кэш logger.isEnabledFor(INFO) для горячего пути (обновляется в start())
+        self._info_enabled = logger.isEnabledFor(logging.INFO)
+        # пул из max_concurrent_tasks воркеров — concurrency ограничена их числом
+        self._workers: List[asyncio.Task] = []
 
     async def add_task(
         self,
@@ -81,93 +94,75 @@ class TaskQueue:
         Добавляет задачу. priority: 0 (высокий), 1 (обычный).
         _timeout (сек): опциональный таймаут выполнения (через asyncio.wait_for).
         """
-        task_id = str(uuid.uuid4())
+        self._id_counter += 1
+        task_id = f"{_ID_PREFIX}{self._id_counter:016x}"
         created_ts = time.time()
 
-        async with self._heap_lock:
-            self._seq += 1
-            item = _PQItem(
-                prio=int(priority),
-                created_ts=created_ts,
-                seq=self._seq,
-                id=task_id,
-                func=task_func,
-                args=args,
-                kwargs=kwargs,
-                timeout=_timeout,
-            )
-            import heapq
-            heapq.heappush(self._heap, item)
-            heap_size = len(self._heap)
+        item = _PQItem(
+            id=task_id,
+            func=task_func,
+            args=args or _EMPTY_ARGS,
+            kwargs=kwargs or _EMPTY_KWARGS,
+            timeout=_timeout,
+        )
+        async with self._queue_cond:
+            (self._hi if int(priority) <= 0 else self._lo).append(item)
+            queue_size = len(self._hi) + len(self._lo)
+            self._queue_cond.notify()
 
         try:
             _TASKS_ENQUEUED.inc()
-            _QUEUE_SIZE.set(heap_size)
+            _QUEUE_SIZE.set(queue_size)
         except Exception:
             pass
 
         self.task_results[task_id] = {
             "status": "queued",
-            "created_at": datetime.fromtimestamp(created_ts),
+            "created_at": created_ts,
             "priority": int(priority),
             "func_name": getattr(task_func, "__name__", str(task_func)),
         }
 
-        logger.info("Задача %s добавлена: prio=%s, heap_size=%d", task_id, priority, heap_size)
+        if self._info_enabled:
+            logger.info("Задача %s добавлена: prio=%s, queue_size=%d", task_id, priority, queue_size)
 
         # Чтобы не разрасталась история (опционально)
         self.purge_old_results(max_items=5000)
 
         return task_id
 
-    async def _worker(self):
+    async def _pop_with_wait(self) -> _PQItem:
+        """Ждёт появления задачи в очереди и достаёт следующую по приоритету."""
+        async with self._queue_cond:
+            await self._queue_cond.wait_for(lambda: self._hi or self._lo)
+            item = self._hi.popleft() if self._hi else self._lo.popleft()
+            queue_size = len(self._hi) + len(self._lo)
+        try:
+            _QUEUE_SIZE.set(queue_size)
+        except Exception:
+            pass
+        return item
+
+    async def _worker_loop(self):
         logger.info("Воркер очереди запущен")
         try:
             while self._is_running:
                 try:
-                    # ждём свободный слот
-                    if len(self.active_tasks) >= self.max_concurrent_tasks:
-                        await asyncio.sleep(0.05)
-                     try:
-                            _ACTIVE_TASKS.set(len(self.active_tasks))
-                            _QUEUE_SIZE.set(len(self._heap))
-                        except Exception:
-                            pass   
-                        continue
-
-                    # достаём из кучи следующую задачу
-                    async with self._heap_lock:
-                        if not self._heap:
-                            item = None
-                        else:
-                            import heapq
-                            item = heapq.heappop(self._heap)
-
-                    if not item:
-                        await asyncio.sleep(0.05)
-                        try:
-                            _ACTIVE_TASKS.set(len(self.active_tasks))
-                            _QUEUE_SIZE.set(0)
-                        except Exception:
-                            pass
-                        continue
+                    item = await self._pop_with_wait()
 
                     task_id = item.id
                     self.task_results[task_id].update({
                         "status": "processing",
-                        "started_at": datetime.now(),
+                        "started_at": time.time(),
                     })
-
-                    # запускаем обработчик
-                    coro = self._execute_task(item)
-                    task = asyncio.create_task(coro)
-                    self.active_tasks[task_id] = task
+                    self.active_tasks[task_id] = asyncio.current_task()
                     try:
                         _ACTIVE_TASKS.set(len(self.active_tasks))
-                        _QUEUE_SIZE.set(len(self._heap))
                     except Exception:
                         pass
 
+                    await self._execute_task(item)
+
                 except asyncio.CancelledError:
                     break
                 except Exception as e:
@@ -181,10 +176,14 @@ class TaskQueue:
         task_id = item.id
         try:
             start = time.perf_counter()
+            if item.args is _EMPTY_ARGS and item.kwargs is _EMPTY_KWARGS:
+                coro = item.func()
+            else:
+                coro = item.func(*item.args, **item.kwargs)
             if item.timeout is not None and item.timeout > 0:
-                result = await asyncio.wait_for(item.func(*item.args, **item.kwargs), timeout=item.timeout)
+                result = await asyncio.wait_for(coro, timeout=item.timeout)
             else:
-                result = await item.func(*item.args, **item.kwargs)
+                result = await coro
             try:
                 _TASK_DURATION.observe(time.perf_counter() - start)
             except Exception:
@@ -192,11 +191,12 @@ class TaskQueue:
 
             self.task_results[task_id].update({
                 "status": "completed",
-                "completed_at": datetime.now(),
+                "completed_at": time.time(),
                 "result": result,
                 "error": None,
             })
-            logger.info("Задача %s выполнена", task_id)
+            if self._info_enabled:
+                logger.info("Задача %s выполнена", task_id)
             try:
                 _TASKS_COMPLETED.inc()
             except Exception:
@@ -205,7 +205,7 @@ class TaskQueue:
         except asyncio.TimeoutError:
             self.task_results[task_id].update({
                 "status": "failed",
-                "completed_at": datetime.now(),
+                "completed_at": time.time(),
                 "result": None,
                 "error": f"timeout({item.timeout}s)",
             })
@@ -215,9 +215,13 @@ class TaskQueue:
             except Exception:
                 pass
         except asyncio.CancelledError:
+            # Отменена задача, а не воркер: снимаем запрос отмены и продолжаем цикл
+            worker = asyncio.current_task()
+            if worker is not None and hasattr(worker, "uncancel"):
+                worker.uncancel()
             self.task_results[task_id].update({
                 "status": "canceled",
-                "completed_at": datetime.now(),
+                "completed_at": time.time(),
                 "result": None,
                 "error": "canceled",
             })
@@ -229,7 +233,7 @@ class TaskQueue:
         except Exception as e:
             self.task_results[task_id].update({
                 "status": "failed",
-                "completed_at": datetime.now(),
+                "completed_at": time.time(),
                 "result": None,
                 "error": str(e),
             })
@@ -240,19 +244,30 @@ class TaskQueue:
                 pass
         finally:
             self.active_tasks.pop(task_id, None)
-             try:
+            try:
                 _ACTIVE_TASKS.set(len(self.active_tasks))
             except Exception:
                 pass
 
     def get_task_status(self, task_id: str) -> Dict[str, Any]:
-        """Текущий статус задачи (или {'status': 'not_found'})."""
-        return self.task_results.get(task_id, {"status": "not_found"})
+        """
+        Текущий статус задачи (или {'status': 'not_found'}).
+        Метки времени хранятся как float (time.time()), в datetime превращаем только здесь.
+        """
+        rec = self.task_results.get(task_id)
+        if rec is None:
+            return {"status": "not_found"}
+        out = dict(rec)
+        for key in _TS_KEYS:
+            ts = out.get(key)
+            if ts is not None:
+                out[key] = datetime.fromtimestamp(ts)
+        return out
 
     def get_queue_stats(self) -> Dict[str, int]:
         """Короткая статистика по очереди."""
         return {
-            "queue_size": len(self._heap),
+            "queue_size": len(self._hi) + len(self._lo),
             "active_tasks": len(self.active_tasks),
             "total_tasks": len(self.task_results),
             "max_concurrent": self.max_concurrent_tasks,
@@ -263,14 +278,18 @@ class TaskQueue:
         Позиция задачи в очереди (0 — следующая к запуску).
         Если задача не в очереди (выполняется/завершена/нет) — None.
         """
-        async with self._heap_lock:
-            items = list(self._heap)
-        if not items:
+        rec = self.task_results.get(task_id)
+        if not rec or rec.get("status") != "queued":
             return None
-        items_sorted = sorted(items)  # порядок _PQItem
-        for idx, it in enumerate(items_sorted):
+        # Один проход по нужной очереди, без копий и блокировки (между await'ами
+        # очередь не меняется). Все задачи из _hi стоят перед задачами из _lo.
+        if int(rec.get("priority", 1)) <= 0:
+            dq, offset = self._hi, 0
+        else:
+            dq, offset = self._lo, len(self._hi)
+        for idx, it in enumerate(dq):
             if it.id == task_id:
-                return idx
+                return offset + idx
         return None
 
     def cancel(self, task_id: str) -> bool:
@@ -278,31 +297,29 @@ class TaskQueue:
         Отменяет задачу, если она в очереди или выполняется.
         True — если отменили.
         """
-        # 1) Попробуем убрать из кучи (без блокировки — короткая операция, риск гонки минимален)
+        # 1) Попробуем убрать из очереди (без await — гонки с воркерами нет)
         removed = False
-        try:
-            for idx, it in enumerate(self._heap):
+        for dq in (self._hi, self._lo):
+            for idx, it in enumerate(dq):
                 if it.id == task_id:
-                    self._heap.pop(idx)
-                    import heapq
-                    heapq.heapify(self._heap)
+                    del dq[idx]
                     removed = True
                     break
-        except Exception:
-            pass
+            if removed:
+                break
 
         if removed:
             self.task_results.setdefault(task_id, {})["status"] = "canceled"
-            self.task_results[task_id]["completed_at"] = datetime.now()
+            self.task_results[task_id]["completed_at"] = time.time()
             logger.info("Задача %s отменена (из очереди)", task_id)
             try:
-                _QUEUE_SIZE.set(len(self._heap))
+                _QUEUE_SIZE.set(len(self._hi) + len(self._lo))
                 _TASKS_CANCELED.inc()
             except Exception:
                 pass
             return True
 
-        # 2) Если уже выполняется — отменяем asyncio.Task
+        # 2) Если уже выполняется — отменяем воркер (он переживёт отмену задачи)
         task = self.active_tasks.get(task_id)
         if task and not task.done():
             task.cancel()
@@ -321,43 +338,49 @@ class TaskQueue:
         if n <= max_items:
             return
         items = list(self.task_results.items())
-        items.sort(key=lambda kv: kv[1].get("created_at", datetime.min))
+        items.sort(key=lambda kv: kv[1].get("created_at", 0.0))
         for tid, _ in items[: n - max_items]:
             self.task_results.pop(tid, None)
 
     async def start(self):
-        """Запускает воркер (идемпотентно)."""
+        """Запускает пул воркеров (идемпотентно)."""
         if self._is_running:
             return
         self._is_running = True
-        self._worker_task = asyncio.create_task(self._worker())
+        self._info_enabled = logger.isEnabledFor(logging.INFO)
+        # Воркеры живут в собственном пустом контексте, а не в копии контекста
+        # вызывающего (post_init бота): задачи не видят его ContextVar'ы.
+        self._workers = [
+            contextvars.Context().run(asyncio.create_task, self._worker_loop())
+            for _ in range(max(1, self.max_concurrent_tasks))
+        ]
 
     async def stop(self, graceful: bool = True, cancel_active: bool = False):
         """
         Останавливает очередь.
-        graceful=True — перестаём брать новые задачи и ждём завершения воркера.
+        graceful=True — перестаём брать новые задачи и ждём завершения активных.
         cancel_active=True — принудительно отменить активные задачи.
         """
         if not self._is_running:
             return
         self._is_running = False
 
-        if self._worker_task:
-            self._worker_task.cancel()
-            try:
-                await self._worker_task
-            except asyncio.CancelledError:
-                pass
-            self._worker_task = None
-
+        # Свободные воркеры ждут в _pop_with_wait — их просто отменяем.
+        # Занятые сами выйдут из цикла после текущей задачи.
+        busy = {t for t in self.active_tasks.values() if not t.done()}
+        pending = {w for w in self._workers if not w.done()}
+        for w in pending - busy:
+            w.cancel()
         if cancel_active:
-            for tid, t in list(self.active_tasks.items()):
-                if not t.done():
-                    t.cancel()
-            await asyncio.sleep(0)
+            for t in busy:
+                t.cancel()
+        elif not graceful:
+            pending -= busy
+
+        if pending:
+            await asyncio.wait(pending, return_when=asyncio.ALL_COMPLETED)
 
-        if graceful and self.active_tasks:
-            await asyncio.gather(*self.active_tasks.values(), return_exceptions=True)
+        self._workers = []
 
 
 # --- Singleton-инстанс очереди для всего бота (ВАЖНО: на уровне модуля) ---
@@ -1,15 +1,44 @@
 # app/translator.py
 import logging
+import random
+import re
+import threading
 import time
-from typing import List, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from deep_translator import GoogleTranslator
+from deep_translator.exceptions import RequestError, TooManyRequests
+
+from app import translator_cache
+from app.config import TR_CONCURRENCY, TR_DETECT
+
+try:
+    from lingua import LanguageDetectorBuilder  # type: ignore
+except Exception:  # pragma: no cover
+    LanguageDetectorBuilder = None
 
 logger = logging.getLogger(__name__)
 
 _MAX_CHARS = 4000        # безопасный размер на батч
 _RETRIES = 3             # число попыток
-_BACKOFF_BASE = 0.7      # секунды (линейный бэкофф)
+_BACKOFF_BASE = 1.0      # секунды (экспоненциальный бэкофф: base * 2**attempt)
+_BACKOFF_CAP = 30.0      # потолок одной паузы, сек
+_BACKOFF_JITTER = 0.5    # до +50% случайной добавки к паузе
+_RETRY_BUDGET_S = 60.0   # общий бюджет времени на все попытки, сек
+# Ретраим только сетевые/временные ошибки (таймауты, 429, 5xx);
+# неверный язык/пейлоад и т.п. пробрасываем сразу.
+_RECOVERABLE = (
+    requests.exceptions.RequestException,
+    TimeoutError,
+    ConnectionError,
+    TooManyRequests,
+    RequestError,
+)
 _LANG_ALIASES = {
     "ua": "uk",
     "cn": "zh-CN",
@@ -18,7 +47,64 @@ _LANG_ALIASES = {
     "pt-br": "pt",
 }
 
-_TRANSLATOR_CACHE: dict[Tuple[Optional[str], str], GoogleTranslator] = {}
+# Общий пул для параллельного перевода кусков (<=0 или мусор в env → 4)
+_CONCURRENCY = TR_CONCURRENCY if TR_CONCURRENCY > 0 else 4
+_POOL = ThreadPoolExecutor(max_workers=_CONCURRENCY, thread_name_prefix="translate")
+
+# Детектор языка (TR_DETECT=1): строится лениво при первом переводе — модели весят ~50 МБ
+_DETECTOR = None
+_DETECTOR_LOCK = threading.Lock()
+_DETECT_MIN_DISTANCE = 0.1  # неуверенный ответ -> None -> кусок всё равно переводим
+
+# Абзац: от первого непробельного символа до последнего, без пустых строк ("\n\n") внутри
+_PARA_RE = re.compile(r"\S(?:[^\n]*(?:\n(?!\n)[^\n]*)*\S)?")
+
+# Переводчики по (source, target) — свои в каждом потоке: GoogleTranslator
+# кладёт текст запроса в self._url_params, общий экземпляр между потоками делить нельзя.
+# В каждом потоке — LRU на _TRANSLATOR_CACHE_MAX пар.
+_TRANSLATOR_CACHE_MAX = 32
+_TRANSLATORS = threading.local()
+
+# Общая HTTP-сессия: keep-alive между кусками и переводчиками (без TLS-рукопожатия на каждый запрос).
+# Транспортные ретраи — только на 5xx/обрывы; 429 и остальное решает _retry_call с джиттером.
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+    ),
+)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+
+
+class _SessionRequests:
+    """Подмена модуля requests внутри deep_translator.google: get/post идут через _SESSION."""
+
+    get = staticmethod(_SESSION.get)
+    post = staticmethod(_SESSION.post)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+def _install_session() -> None:
+    # deep_translator ходит в сеть через модульный requests.get(...) без сессии;
+    # если внутренности библиотеки поменяются — просто остаёмся без пула
+    try:
+        from deep_translator import google as _dt_google
+        if getattr(_dt_google, "requests", None) is requests:
+            _dt_google.requests = _SessionRequests()
+    except Exception as e:
+        logger.warning("Shared HTTP session for translator not installed: %s", e)
+
+
+_install_session()
 
 
 def _normalize_lang(code: Optional[str]) -> Optional[str]:
@@ -32,73 +118,173 @@ def _chunk(text: str, limit: int = _MAX_CHARS) -> List[str]:
     """Бьём на куски по абзацам, стараясь не превышать лимит."""
     if not text:
         return []
-    parts, buf = [], []
+    parts: List[str] = []
+    buf_spans: List[Tuple[int, int]] = []
     total = 0
-    for paragraph in text.split("\n\n"):
-        p = paragraph.strip()
-        if not p:
-            continue
-        need = len(p) + (2 if buf else 0)  # запас на разделитель
-        if buf and total + need > limit:
-            parts.append("\n\n".join(buf))
-            buf, total = [p], len(p)
+    for m in _PARA_RE.finditer(text):
+        s, e = m.span()
+        n = e - s
+        need = n + (2 if buf_spans else 0)  # запас на разделитель
+        if buf_spans and total + need > limit:
+            parts.append("\n\n".join(text[a:b] for a, b in buf_spans))
+            buf_spans, total = [(s, e)], n
         else:
-            if buf:
-                buf.append(p)
-                total += need
-            else:
-                buf = [p]
-                total = len(p)
-    if buf:
-        parts.append("\n\n".join(buf))
+            buf_spans.append((s, e))
+            total += need
+    if buf_spans:
+        parts.append("\n\n".join(text[a:b] for a, b in buf_spans))
     return parts
 
 
 def _get_translator(source: Optional[str], target: str) -> GoogleTranslator:
-    key = (source, target)
-    tr = _TRANSLATOR_CACHE.get(key)
-    if tr is None:
-        tr = GoogleTranslator(source=source or "auto", target=target)
-        _TRANSLATOR_CACHE[key] = tr
+    """Переводчик для текущего потока (потоков — пул и to_thread)."""
+    cache: "Optional[OrderedDict[Tuple[str, str], GoogleTranslator]]" = getattr(_TRANSLATORS, "cache", None)
+    if cache is None:
+        cache = _TRANSLATORS.cache = OrderedDict()
+    key = (source or "auto", target)
+    tr = cache.get(key)
+    if tr is not None:
+        cache.move_to_end(key)
+        return tr
+    tr = cache[key] = GoogleTranslator(source=key[0], target=target)
+    if len(cache) > _TRANSLATOR_CACHE_MAX:
+        cache.popitem(last=False)
     return tr
 
 
+def _get_detector():
+    global _DETECTOR
+    if not TR_DETECT or LanguageDetectorBuilder is None:
+        return None
+    if _DETECTOR is None:
+        with _DETECTOR_LOCK:
+            if _DETECTOR is None:
+                try:
+                    _DETECTOR = (
+                        LanguageDetectorBuilder.from_all_languages()
+                        .with_minimum_relative_distance(_DETECT_MIN_DISTANCE)
+                        .build()
+                    )
+                except Exception as e:
+                    logger.warning("Language detector init failed, detection disabled: %s", e)
+                    _DETECTOR = False
+    return _DETECTOR or None
+
+
+def _detect_langs(chunks: List[str]) -> List[Optional[str]]:
+    """ISO 639-1 (в нижнем регистре) для каждого куска; None — не определили или детектор выключен."""
+    detector = _get_detector()
+    if detector is None:
+        return [None] * len(chunks)
+    out: List[Optional[str]] = []
+    for c in chunks:
+        try:
+            lang = detector.detect_language_of(c)
+            out.append(lang.iso_code_639_1.name.lower() if lang is not None else None)
+        except Exception:
+            out.append(None)
+    return out
+
+
+def _base_lang(code: str) -> str:
+    """'zh-CN' -> 'zh': детектор отдаёт только двухбуквенный код."""
+    return code.split("-", 1)[0].lower()
+
+
 def _retry_call(fn, *args, **kwargs):
+    """Ретраи с экспоненциальным бэкоффом и джиттером; невосстановимые ошибки — сразу наружу."""
+    started = time.monotonic()
     last_exc = None
-    for attempt in range(1, _RETRIES + 1):
+    for attempt in range(_RETRIES):
         try:
             return fn(*args, **kwargs)
-        except Exception as e:
+        except _RECOVERABLE as e:
             last_exc = e
-            if attempt < _RETRIES:
-                sleep_s = _BACKOFF_BASE * attempt
-                time.sleep(sleep_s)
+            if attempt + 1 >= _RETRIES:
+                break
+            sleep_s = min(_BACKOFF_CAP, _BACKOFF_BASE * 2 ** attempt) * (1 + random.uniform(0, _BACKOFF_JITTER))
+            if time.monotonic() - started + sleep_s > _RETRY_BUDGET_S:
+                break
+            time.sleep(sleep_s)
     raise last_exc  # пусть внешняя логика решит, что делать
 
 
-def _translate_batch_safe(translator: GoogleTranslator, chunks: List[str]) -> List[str]:
-    """Пробуем батч; при ошибке — поштучно с ретраями; при полном фейле — исходный текст."""
+def _dedup(chunks: List[str]) -> Tuple[List[str], List[int]]:
+    """Уникальные куски (в порядке появления) и индекс уникального для каждого исходного."""
+    seen: Dict[str, int] = {}
+    unique: List[str] = []
+    inverse: List[int] = []
+    for c in chunks:
+        idx = seen.setdefault(c, len(unique))
+        if idx == len(unique):
+            unique.append(c)
+        inverse.append(idx)
+    return unique, inverse
+
+
+def _translate_one(source: str, target: str, chunk: str) -> Optional[str]:
+    """Перевод одного куска в потоке пула; None — если не удалось."""
+    try:
+        translator = _get_translator(source, target)
+        return _retry_call(translator.translate, chunk)
+    except Exception as e:
+        logger.error("Chunk translate failed, keeping original chunk: %s", e)
+        return None
+
+
+def _translate_batch_safe(translator: GoogleTranslator, chunks: List[str], source: str, target: str) -> List[str]:
+    """
+    Сначала кэш (translator_cache); промахи — батчем, при ошибке — поштучно с ретраями;
+    при полном фейле — исходный текст (такие куски не кэшируются).
+    """
     if not chunks:
         return []
 
+    # Повторяющиеся куски (шапки, реплики спикеров) переводим один раз
+    unique, inverse = _dedup(chunks)
+    if len(unique) < len(chunks):
+        unique_out = _translate_batch_safe(translator, unique, source, target)
+        return [unique_out[i] for i in inverse]
+
+    hashes = [translator_cache.text_hash(c) for c in chunks]
+    out: List[Optional[str]] = translator_cache.get_many(hashes, source, target)
+    # При source=auto куски, уже написанные на target, в переводчик не шлём
+    if source == "auto" and any(v is None for v in out):
+        tgt = _base_lang(target)
+        for i, lang in enumerate(_detect_langs(chunks)):
+            if out[i] is None and lang == tgt:
+                out[i] = chunks[i]
+    miss_idx = [i for i, v in enumerate(out) if v is None]
+    if not miss_idx:
+        return out
+    missing = [chunks[i] for i in miss_idx]
+    fresh: Dict[str, str] = {}
+
     # 1) Батч с ретраями
     try:
-        res = _retry_call(translator.translate_batch, chunks)
+        res = _retry_call(translator.translate_batch, missing)
         # deep_translator может вернуть строку для 1 элемента
         if isinstance(res, str):
-            return [res]
-        return [str(x) if x is not None else "" for x in res]
+            res = [res]
+        if len(res) != len(missing):
+            raise ValueError(f"batch returned {len(res)} items for {len(missing)} chunks")
+        for i, x in zip(miss_idx, res):
+            out[i] = str(x) if x is not None else ""
+            fresh[hashes[i]] = out[i]
+        translator_cache.set_many(fresh, source, target)
+        return out
     except Exception as e:
-        logger.warning(f"Batch translate failed, fallback to per-chunk: {e}")
+        logger.warning("Batch translate failed, fallback to per-chunk: %s", e)
 
-    # 2) Поштучно с ретраями
-    out: List[str] = []
-    for ch in chunks:
-        try:
-            out.append(_retry_call(translator.translate, ch))
-        except Exception as e:
-            logger.error(f"Chunk translate failed, keeping original chunk: {e}")
-            out.append(ch)  # мягкий фолбэк: возвращаем оригинал
+    # 2) Поштучно с ретраями, параллельно в общем пуле (порядок сохраняет map)
+    results = _POOL.map(lambda c: _translate_one(source, target, c), missing)
+    for i, res in zip(miss_idx, results):
+        if res is None:
+            out[i] = chunks[i]  # мягкий фолбэк: возвращаем оригинал
+        else:
+            out[i] = res
+            fresh[hashes[i]] = res
+    translator_cache.set_many(fresh, source, target)
     return out
 
 
@@ -122,9 +308,68 @@ def translate_text(text: str, target_lang: str, source_lang: str = "auto") -> st
     try:
         chunks = _chunk(text)
         translator = _get_translator(source, target)
-        translated_list = _translate_batch_safe(translator, chunks)
+        translated_list = _translate_batch_safe(translator, chunks, source or "auto", target)
         return "\n\n".join(translated_list).strip()
     except Exception as e:
-        logger.exception(f"Translation failed hard, returning original: {e}")
+        logger.exception("Translation failed hard, returning original: %s", e)
         # Мягкий фолбэк — отдаём исходный текст
         return text
+
+
+def translate_text_multi(text: str, target_langs: List[str], source_lang: str = "auto") -> Dict[str, str]:
+    """
+    Перевод одного текста сразу на несколько языков: {target_lang: перевод}.
+    - Текст режется на куски один раз
+    - Кэш проверяется по каждому языку, промахи всех языков идут параллельно в общий пул
+    - Для куска/языка, который не удалось перевести, — исходный текст куска
+    """
+    if not target_langs:
+        return {}
+    if not text:
+        return {lang: "" for lang in target_langs}
+
+    source = _normalize_lang(source_lang)
+    src_key = source or "auto"
+    norm = {lang: _normalize_lang(lang) or "en" for lang in target_langs}
+
+    try:
+        # Повторяющиеся куски переводим один раз, раскладываем обратно при сборке
+        chunks, inverse = _dedup(_chunk(text))
+        hashes = [translator_cache.text_hash(c) for c in chunks]
+
+        # Язык кусков определяем один раз на все target (только при source=auto)
+        detected = _detect_langs(chunks) if src_key == "auto" else [None] * len(chunks)
+
+        done: Dict[str, str] = {}
+        outs: Dict[str, List[Optional[str]]] = {}
+        futures = []
+        for target in dict.fromkeys(norm.values()):
+            # Если явный source совпадает с target — не переводим
+            if source and source != "auto" and source == target:
+                done[target] = text
+                continue
+            out = translator_cache.get_many(hashes, src_key, target)
+            outs[target] = out
+            tgt = _base_lang(target)
+            for i, v in enumerate(out):
+                if v is None and detected[i] == tgt:
+                    out[i] = chunks[i]  # уже на целевом языке
+                elif v is None:
+                    futures.append((target, i, _POOL.submit(_translate_one, src_key, target, chunks[i])))
+
+        fresh: Dict[str, Dict[str, str]] = {t: {} for t in outs}
+        for target, i, fut in futures:
+            res = fut.result()
+            if res is None:
+                outs[target][i] = chunks[i]  # мягкий фолбэк: возвращаем оригинал
+            else:
+                outs[target][i] = res
+                fresh[target][hashes[i]] = res
+
+        for target, out in outs.items():
+            translator_cache.set_many(fresh[target], src_key, target)
+            done[target] = "\n\n".join(out[i] for i in inverse).strip()
+        return {lang: done[norm[lang]] for lang in target_langs}
+    except Exception as e:
+        logger.exception("Multi-translation failed hard, returning original: %s", e)
+        return {lang: text for lang in target_langs}
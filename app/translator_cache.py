@@ -0,0 +1,92 @@
+# app/translator_cache.py
+"""
+Кэш переводов по кускам текста.
+Ключ: tr:v1:{sha1(chunk)}:{source}:{target}.
+Redis (REDIS_URL) — если доступен; иначе in-process LRU на _LOCAL_MAX записей.
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from app.config import REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+_TTL_S = 14 * 86400       # 14 дней
+_LOCAL_MAX = 4096         # размер локального LRU
+
+# ---- Redis (опционально) ----
+_redis = None
+if REDIS_URL:
+    try:
+        import redis  # type: ignore
+        _redis = redis.from_url(REDIS_URL, decode_responses=True)
+        _redis.ping()
+    except Exception as e:
+        logger.warning("⚠️ Redis для кэша переводов недоступен: %s", e)
+        _redis = None
+
+# ---- Memory fallback ----
+# translate_text вызывается из asyncio.to_thread — защищаем LRU блокировкой
+_local: "OrderedDict[str, str]" = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _key(h: str, source: str, target: str) -> str:
+    return f"tr:v1:{h}:{source}:{target}"
+
+
+def get_many(hashes: List[str], source: str, target: str) -> List[Optional[str]]:
+    """Переводы по хэшам кусков (None — промах), в том же порядке."""
+    if not hashes:
+        return []
+    keys = [_key(h, source, target) for h in hashes]
+
+    # Redis
+    if _redis:
+        try:
+            return list(_redis.mget(keys))
+        except Exception as e:
+            logger.debug("Redis translator_cache get error: %s", e)
+
+    # Memory
+    out: List[Optional[str]] = []
+    with _local_lock:
+        for k in keys:
+            v = _local.get(k)
+            if v is not None:
+                _local.move_to_end(k)
+            out.append(v)
+    return out
+
+
+def set_many(items: Dict[str, str], source: str, target: str, ttl: int = _TTL_S) -> None:
+    """Сохраняет переводы {hash: translated}."""
+    if not items:
+        return
+
+    # Redis
+    if _redis:
+        try:
+            pipe = _redis.pipeline(transaction=False)
+            for h, text in items.items():
+                pipe.set(_key(h, source, target), text, ex=int(ttl))
+            pipe.execute()
+            return
+        except Exception as e:
+            logger.debug("Redis translator_cache set error: %s", e)
+
+    # Memory
+    with _local_lock:
+        for h, text in items.items():
+            k = _key(h, source, target)
+            _local[k] = text
+            _local.move_to_end(k)
+        while len(_local) > _LOCAL_MAX:
+            _local.popitem(last=False)
@@ -1,12 +1,43 @@
 # app/utils.py
 import os
+import functools
 import logging
+import re
 import subprocess
-from datetime import timedelta
-from typing import Optional
+from typing import Dict, Literal, Optional
 
 logger = logging.getLogger(__name__)
 
+# PyAV (libavformat в процессе) — опционально; без него остаётся ffprobe/pydub
+try:
+    import av  # type: ignore
+except Exception:
+    av = None  # type: ignore
+
+# soundfile (libsndfile) — опционально; читает только заголовок WAV/FLAC/OGG
+try:
+    import soundfile as sf  # type: ignore
+except Exception:
+    sf = None  # type: ignore
+
+# "Duration: 00:01:02.34" из баннера `ffmpeg -i`
+_FFMPEG_DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+def _av_duration_seconds(file_path: str) -> Optional[float]:
+    """
+    Длительность из заголовка контейнера через PyAV — без запуска ffprobe.
+    """
+    if av is None:
+        return None
+    try:
+        with av.open(file_path) as container:
+            if container.duration:
+                return float(container.duration) / av.time_base
+    except Exception:
+        return None
+    return None
+
 
 def _ffprobe_duration_seconds(file_path: str) -> Optional[float]:
     """
@@ -28,7 +59,45 @@ def _ffprobe_duration_seconds(file_path: str) -> Optional[float]:
     return None
 
 
+def _soundfile_duration_seconds(file_path: str) -> Optional[float]:
+    if sf is None:
+        return None
+    try:
+        return float(sf.info(file_path).duration)
+    except Exception:
+        return None
+
+
+def _ffmpeg_banner_duration_seconds(file_path: str) -> Optional[float]:
+    """
+    Длительность из stderr `ffmpeg -i` (заголовок контейнера, без декодирования).
+    """
+    try:
+        proc = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-i", file_path],
+            capture_output=True, text=True, errors="replace",
+        )
+        m = _FFMPEG_DURATION_RE.search(proc.stderr or "")
+        if m:
+            h, mnt, sec = m.groups()
+            return int(h) * 3600 + int(mnt) * 60 + float(sec)
+    except Exception:
+        return None
+    return None
+
+
 def _pydub_duration_seconds(file_path: str) -> Optional[float]:
+    """
+    Последний рубеж: сначала заголовок (soundfile / `ffmpeg -i`),
+    и только потом pydub, который декодирует весь файл в память.
+    """
+    dur = _soundfile_duration_seconds(file_path)
+    if dur is None:
+        dur = _ffmpeg_banner_duration_seconds(file_path)
+    if dur is not None:
+        return dur
+
+    logger.warning("Длительность '%s' определяется полным декодированием (pydub)", file_path)
     try:
         from pydub import AudioSegment  # импорт лениво, чтобы не ругаться без ffmpeg
         audio = AudioSegment.from_file(file_path)
@@ -38,15 +107,12 @@ def _pydub_duration_seconds(file_path: str) -> Optional[float]:
         return None
 
 
-def get_audio_duration(file_path: str) -> int:
-    """
-    Определяет длительность аудио/видео в секундах (целое),
-    сначала через ffprobe, затем через pydub.
-    """
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(file_path)
-
-    dur = _ffprobe_duration_seconds(file_path)
+@functools.lru_cache(maxsize=512)
+def _cached_duration(file_path: str, mtime_ns: int, size: int) -> int:
+    """mtime_ns/size входят в ключ: перезапись файла = новый ключ, старый вытеснится."""
+    dur = _av_duration_seconds(file_path)
+    if dur is None:
+        dur = _ffprobe_duration_seconds(file_path)
     if dur is None:
         dur = _pydub_duration_seconds(file_path)
     if dur is None:
@@ -54,19 +120,51 @@ def get_audio_duration(file_path: str) -> int:
     return int(round(dur))
 
 
+def get_audio_duration(file_path: str) -> int:
+    """
+    Определяет длительность аудио/видео в секундах (целое):
+    PyAV → ffprobe → pydub. Результат кэшируется по (path, mtime, size).
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        raise FileNotFoundError(file_path) from None
+    return _cached_duration(file_path, st.st_mtime_ns, st.st_size)
+
+
+get_audio_duration.cache_clear = _cached_duration.cache_clear  # type: ignore[attr-defined]
+
+
 def format_seconds(seconds: int) -> str:
-    """Формат ЧЧ:ММ:СС."""
-    return str(timedelta(seconds=max(0, int(seconds))))
+    """Формат Ч:ММ:СС (часы без ведущего нуля, как у timedelta)."""
+    h, rem = divmod(max(0, int(seconds)), 3600)
+    m, sec = divmod(rem, 60)
+    return f"{h}:{m:02d}:{sec:02d}"
+
+
+# Расширение (без точки, в нижнем регистре) -> тип медиа.
+# .webm бывает и аудио, и видео — относим к "video" (MIME по умолчанию video/webm).
+_EXT_KIND: Dict[str, str] = {
+    **dict.fromkeys(("mp3", "wav", "ogg", "m4a", "flac", "aac"), "audio"),
+    **dict.fromkeys(("mp4", "avi", "mov", "wmv", "flv", "mkv", "webm"), "video"),
+}
+
+
+def classify_file(filename: str) -> Optional[Literal["audio", "video"]]:
+    """'audio' / 'video' по расширению файла, иначе None."""
+    base, dot, ext = os.path.basename(filename).rpartition(".")
+    # "mp3" и ".mp3" — это имя без расширения (как у os.path.splitext)
+    if not dot or not base.lstrip("."):
+        return None
+    return _EXT_KIND.get(ext.lower())  # type: ignore[return-value]
 
 
 def is_audio_file(filename: str) -> bool:
-    audio_extensions = {".mp3", ".wav", ".ogg", ".m4a", ".flac", ".aac", ".webm"}
-    return os.path.splitext(filename)[1].lower() in audio_extensions
+    return classify_file(filename) == "audio"
 
 
 def is_video_file(filename: str) -> bool:
-    video_extensions = {".mp4", ".avi", ".mov", ".wmv", ".flv", ".mkv", ".webm"}
-    return os.path.splitext(filename)[1].lower() in video_extensions
+    return classify_file(filename) == "video"
 
 
 def get_file_size_mb(file_path: str) -> float:
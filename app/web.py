@@ -1,46 +1,251 @@
 import logging
 from app.config import LOG_LEVEL
 import asyncio
-from flask import Flask, request, jsonify, Response
+import concurrent.futures
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import orjson
+from flask import Flask, request, Response
+from flask.json.provider import JSONProvider
 from prometheus_client import Counter, Summary, generate_latest, CONTENT_TYPE_LATEST
 
+try:
+    import uvloop  # type: ignore
+except Exception:  # pragma: no cover
+    uvloop = None
+
 logger = logging.getLogger(__name__)
 try:
     logging.basicConfig(level=getattr(logging, str(LOG_LEVEL).upper(), logging.INFO))
 except Exception:
     logging.basicConfig(level=logging.INFO)
 
+
+
+class _OrjsonProvider(JSONProvider):
+    """jsonify / request.get_json через orjson вместо stdlib json."""
+
+    _OPTS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, option=self._OPTS).decode()
+
+    def loads(self, s, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self._OPTS), mimetype="application/json")
+
+
 app = Flask(__name__)
+app.json = _OrjsonProvider(app)
+# Вебхуки — маленькие JSON; больше не читаем (сжатые тела не распаковываем, это задача прокси)
+_MAX_BODY = 64 * 1024
+app.config["MAX_CONTENT_LENGTH"] = _MAX_BODY
 
 # --- Prometheus metrics ---
+REQUESTS_TOTAL = Counter("http_requests_total", "HTTP requests total", ["endpoint", "method"])
 WEBHOOK_LATENCY = Summary("webhook_latency_seconds", "Webhook handler latency")
 WEBHOOK_ERRORS_TOTAL = Counter("webhook_errors_total", "Webhook errors total", ["reason"])
 
+# Отрендеренный /metrics живёт секунду: частые скрейпы не рендерят все метрики заново
+_METRICS_TTL_S = 1.0
+_metrics_cache: Tuple[float, bytes] = (0.0, b"")
+
+
+# (шаблон маршрута, метод) -> готовый child счётчика; заполняется в конце модуля
+_REQUEST_COUNTERS: Dict[Tuple[str, str], Any] = {}
+# Пробы и скрейпы — основная доля запросов и неинтересны в REQUESTS_TOTAL
+_UNCOUNTED_PATHS = frozenset({"/health", "/metrics"})
+
+
+@app.before_request
+def _before_request():
+    if request.path in _UNCOUNTED_PATHS:
+        return
+    # шаблон маршрута, а не путь: случайные 404 не раздувают кардинальность
+    endpoint = request.url_rule.rule if request.url_rule else "unknown"
+    child = _REQUEST_COUNTERS.get((endpoint, request.method))
+    if child is not None:
+        child.inc()
+
 @app.get("/health")
 def health():
-    return jsonify({"ok": True})
+    return _json_response(_HEALTH_OK)
 
 @app.get("/metrics")
 def metrics():
-    data = generate_latest()
+    global _metrics_cache
+    ts, data = _metrics_cache
+    now = time.monotonic()
+    if not data or now - ts >= _METRICS_TTL_S:
+        data = generate_latest()
+        _metrics_cache = (now, data)
     return Response(data, mimetype=CONTENT_TYPE_LATEST)
 
-# --- small helper to run async safely from WSGI context ---
+# --- JSON через orjson (вебхуки) ---
+def _json_response(obj: Any, status: int = 200) -> Response:
+    """obj — данные для orjson или уже готовые байты JSON."""
+    body = obj if isinstance(obj, bytes) else orjson.dumps(obj)
+    return Response(body, status=status, mimetype="application/json")
+
+
+# Постоянные тела ответов: сериализуем один раз при импорте
+_HEALTH_OK = orjson.dumps({"ok": True})
+_ERR_BAD_CONTENT_TYPE = orjson.dumps({"error": "bad content-type"})
+_ERR_TOO_LARGE = orjson.dumps({"error": "payload too large"})
+_ERR_PAYMENTS_DISABLED = orjson.dumps({"error": "Payments disabled"})
+_ERR_SIG_FAILED = orjson.dumps({"error": "Signature verification failed"})
+_ERR_INTERNAL = orjson.dumps({"error": "Internal error"})
+
+
+def _load_json(raw: bytes) -> Dict:
+    """Тело запроса -> dict; невалидный JSON / не объект -> {}."""
+    if not raw:
+        return {}
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _reject_body() -> Optional[Response]:
+    """Ранний отказ до чтения тела: не-JSON Content-Type (415) или заявленный размер > лимита (413)."""
+    if request.content_type and request.mimetype != "application/json":
+        WEBHOOK_ERRORS_TOTAL.labels(reason="bad_content_type").inc()
+        return _json_response(_ERR_BAD_CONTENT_TYPE, 415)
+    if request.content_length is not None and request.content_length > _MAX_BODY:
+        WEBHOOK_ERRORS_TOTAL.labels(reason="too_large").inc()
+        return _json_response(_ERR_TOO_LARGE, 413)
+    return None
+
+
+# --- persistent event loop for async handlers (one per worker process) ---
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOOP_LOCK = threading.Lock()
+_ASYNC_TIMEOUT_S = 15  # не держим поток gunicorn дольше, чем провайдер ждёт ответа
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Долгоживущий event loop в daemon-потоке. Создаётся лениво при первом вебхуке,
+    чтобы корректно пережить fork воркеров gunicorn (в т.ч. с --preload).
+    """
+    global _LOOP
+    if _LOOP is None:
+        with _LOOP_LOCK:
+            if _LOOP is None:
+                # uvloop — только для этого loop, глобальную политику asyncio не трогаем
+                loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="webhook-loop", daemon=True).start()
+                _LOOP = loop
+    return _LOOP
+
+
 def _run_async(coro):
     """
-    Надёжный запуск корутины из Flask (WSGI) обработчика.
-    Работает корректно под обычным gunicorn (рекомендовано).
+    Запуск корутины из Flask (WSGI) обработчика на общем loop:
+    без создания/закрытия цикла на каждый запрос, пулы/сессии внутри менеджера живут между вебхуками.
     """
+    fut = asyncio.run_coroutine_threadsafe(coro, _get_loop())
     try:
-        # Если цикл в этом потоке не запущен — обычный путь
-        asyncio.get_running_loop()
-    except RuntimeError:
-        return asyncio.run(coro)
-    # Теоретический кейс, когда мы реально внутри уже запущенного цикла:
-    # создадим новый loop в отдельном thread-safe вызове.
-    loop = asyncio.get_event_loop()
-    fut = asyncio.run_coroutine_threadsafe(coro, loop)
-    return fut.result()
+        return fut.result(timeout=_ASYNC_TIMEOUT_S)
+    except concurrent.futures.TimeoutError:
+        fut.cancel()
+        raise
+
+# --- фоновая обработка вебхуков из очереди (storage.take_webhook_job) ---
+_JOB_WORKER: Optional[threading.Thread] = None
+_JOB_MAX_ATTEMPTS = 5          # быстрые повторы: 2, 4, 8, 16 с
+_JOB_RETRY_CAP_S = 30
+_JOB_REDRIVE_EVERY_S = 300     # дальше — раз в 5 минут...
+_JOB_MAX_REDRIVES = 288        # ...в течение суток (как повторы самой YooKassa), потом wh:jobs:dead
+_JOB_REQUEUE_EVERY_S = 60      # подбор неподтверждённых заданий (свои и упавших воркеров)
+
+
+def ensure_job_worker() -> None:
+    """
+    Поток-обработчик очереди (один на процесс). Стартует из хука gunicorn post_worker_init
+    (gunicorn.conf.py) — после fork воркера; вебхук вызывает его повторно на случай другого сервера.
+    """
+    global _JOB_WORKER
+    if _JOB_WORKER is None:
+        with _LOOP_LOCK:
+            if _JOB_WORKER is None:
+                t = threading.Thread(target=_job_worker_loop, name="webhook-jobs", daemon=True)
+                t.start()
+                _JOB_WORKER = t
+
+
+def _job_worker_loop() -> None:
+    from app import storage
+    from app.payments_bootstrap import payment_manager
+
+    if not storage.has_webhook_queue() or not hasattr(payment_manager, "process_webhook_job"):
+        logger.info("Webhook job worker not started: no Redis queue or queued payment provider")
+        return
+
+    next_requeue = 0.0
+    while True:
+        try:
+            storage.renew_webhook_lease()
+            now = time.monotonic()
+            if now >= next_requeue:
+                next_requeue = now + _JOB_REQUEUE_EVERY_S
+                stale = storage.requeue_stale_webhook_jobs()
+                if stale:
+                    logger.warning("Requeued %s unfinished webhook jobs", stale)
+            storage.promote_due_webhook_jobs()
+
+            item = storage.take_webhook_job()
+            if item is None:
+                continue
+            _run_job(storage, payment_manager, *item)
+        except Exception:
+            logger.exception("Webhook job worker error")
+            time.sleep(1)
+
+
+def _retry_delay(attempt: int) -> float:
+    return min(_JOB_RETRY_CAP_S, 2 ** attempt) if attempt < _JOB_MAX_ATTEMPTS else _JOB_REDRIVE_EVERY_S
+
+
+def _run_job(storage, payment_manager, raw: str, job: Dict) -> None:
+    """Одно задание; повтор откладывается в очередь (не спим в потоке-потребителе)."""
+    provider = job.get("provider")
+    payload = job.get("payload") or {}
+    try:
+        result = _run_async(payment_manager.process_webhook_job(payload))
+    except Exception as e:
+        logger.exception("Webhook job failed (%s)", provider)
+        result = {"success": False, "error": str(e)}
+
+    if result.get("success"):
+        logger.info("Webhook job OK (%s): %s", provider, result.get("message"))
+    elif result.get("retryable") is False:
+        # повтор не поможет (например, платёж без user_id в metadata) — подтверждаем и считаем
+        logger.error("Webhook job failed permanently (%s): %s", provider, result)
+        WEBHOOK_ERRORS_TOTAL.labels(reason="job_terminal").inc()
+    else:
+        WEBHOOK_ERRORS_TOTAL.labels(reason="job_error").inc()
+        attempt = int(job.get("attempt") or 0) + 1
+        if attempt < _JOB_MAX_ATTEMPTS + _JOB_MAX_REDRIVES:
+            delay = _retry_delay(attempt)
+            logger.warning("Webhook job error, attempt %s, retry in %ss: %s", attempt, delay, result)
+            queued = storage.enqueue_webhook_job(provider, payload, attempt, delay=delay)
+        else:
+            logger.error("Webhook job failed %s times, moved to dead-letter: %s", attempt, result)
+            WEBHOOK_ERRORS_TOTAL.labels(reason="job_dead_letter").inc()
+            queued = storage.bury_webhook_job(provider, payload, attempt)
+        if not queued:
+            # не подтверждаем: задание остаётся в processing и вернётся в очередь при следующем подборе
+            logger.warning("Webhook job retry not queued, left unacked (%s)", provider)
+            return
+    storage.ack_webhook_job(raw)
 
 # --------- Prodamus webhook ----------
 @app.post("/webhook/prodamus")
@@ -49,12 +254,15 @@ def webhook_prodamus():
     from app.payments_bootstrap import payment_manager
     if not payment_manager:
         WEBHOOK_ERRORS_TOTAL.labels(reason="payments_disabled").inc()
-        return jsonify({"error": "Payments disabled"}), 503
+        return _json_response(_ERR_PAYMENTS_DISABLED, 503)
+    rejected = _reject_body()
+    if rejected is not None:
+        return rejected
 
     try:
-        raw = request.get_data()            # байтовый payload для подписи
-        headers = dict(request.headers)     # заголовки (подписанные)
-        payload = request.get_json(silent=True) or {}
+        raw = request.get_data(cache=False)  # читаем тело один раз: те же байты — в подпись и в orjson
+        headers = request.headers           # EnvironHeaders: регистронезависимый .get, без копии
+        payload = _load_json(raw)
 
         # Попробуем достать payment_id для логов (не критично)
         pid = None
@@ -64,18 +272,22 @@ def webhook_prodamus():
         except Exception:
             pid = None
 
-        # Проверка подписи (если менеджер умеет)
+        # Проверка подписи (если менеджер умеет); причина отказа — в метку метрики
         try:
-            if hasattr(payment_manager, "verify_webhook_signature"):
-                ok = payment_manager.verify_webhook_signature(raw, headers)
-                if not ok:
-                    logger.warning("Prodamus webhook: invalid signature (pid=%s)", pid)
-                    WEBHOOK_ERRORS_TOTAL.labels(reason="bad_signature").inc()
-                    return jsonify({"error": "Invalid signature", "payment_id": pid}), 401
+            sig_reason = None
+            if hasattr(payment_manager, "signature_error"):
+                sig_reason = payment_manager.signature_error(raw, headers)
+            elif hasattr(payment_manager, "verify_webhook_signature"):
+                if not payment_manager.verify_webhook_signature(raw, headers):
+                    sig_reason = "bad_signature"
+            if sig_reason:
+                logger.warning("Prodamus webhook: invalid signature (%s, pid=%s)", sig_reason, pid)
+                WEBHOOK_ERRORS_TOTAL.labels(reason=sig_reason).inc()
+                return _json_response({"error": "Invalid signature", "payment_id": pid}, 401)
         except Exception:
             logger.exception("Signature verification error (prodamus)")
             WEBHOOK_ERRORS_TOTAL.labels(reason="sig_verify_exception").inc()
-            return jsonify({"error": "Signature verification failed"}), 400
+            return _json_response(_ERR_SIG_FAILED, 400)
 
         # Запускаем асинхронный обработчик
         result = _run_async(payment_manager.handle_webhook(payload))
@@ -85,31 +297,35 @@ def webhook_prodamus():
             out = dict(result)
             if pid:
                 out["payment_id"] = pid
-            return jsonify(out), 200
+            return _json_response(out, 200)
 
         logger.warning("Prodamus webhook handled with error (pid=%s): %s", pid, result)
         WEBHOOK_ERRORS_TOTAL.labels(reason="handler_error").inc()
         out = dict(result)
         if pid:
             out["payment_id"] = pid
-        return jsonify(out), 400
+        return _json_response(out, 400)
 
     except Exception:
         logger.exception("Webhook error (prodamus)")
         WEBHOOK_ERRORS_TOTAL.labels(reason="exception").inc()
-        return jsonify({"error": "Internal error"}), 500
+        return _json_response(_ERR_INTERNAL, 500)
 
 # --------- YooKassa webhook ----------
 @app.post("/webhook/yookassa")
 @WEBHOOK_LATENCY.time()
 def webhook_yookassa():
+    from app import storage
     from app.payments_bootstrap import payment_manager
     if not payment_manager:
         WEBHOOK_ERRORS_TOTAL.labels(reason="payments_disabled").inc()
-        return jsonify({"error": "Payments disabled"}), 503
+        return _json_response(_ERR_PAYMENTS_DISABLED, 503)
+    rejected = _reject_body()
+    if rejected is not None:
+        return rejected
 
     try:
-        payload = request.get_json(silent=True) or {}
+        payload = _load_json(request.get_data(cache=False))
 
         # Для логов достанем id из object.id, если есть
         pid = None
@@ -119,23 +335,43 @@ def webhook_yookassa():
         except Exception:
             pid = None
 
-        result = _run_async(payment_manager.handle_webhook(payload))
+        # Быстрый ack + очередь в Redis (сверка с API и начисление — в _job_worker_loop);
+        # без Redis очередь не переживёт рестарт — обрабатываем сразу, ошибка -> 400 и повтор от YooKassa
+        if hasattr(payment_manager, "ack_webhook") and storage.has_webhook_queue():
+            ensure_job_worker()
+            result = payment_manager.ack_webhook(payload)
+        else:
+            result = _run_async(payment_manager.handle_webhook(payload))
 
         if result.get("success"):
             logger.info("YooKassa webhook OK (pid=%s): %s", pid, result.get("message"))
             out = dict(result)
             if pid:
                 out["payment_id"] = pid
-            return jsonify(out), 200
+            return _json_response(out, 200)
 
         logger.warning("YooKassa webhook handled with error (pid=%s): %s", pid, result)
         WEBHOOK_ERRORS_TOTAL.labels(reason="handler_error").inc()
         out = dict(result)
         if pid:
             out["payment_id"] = pid
-        return jsonify(out), 400
+        return _json_response(out, 400)
 
     except Exception:
         logger.exception("Webhook error (yookassa)")
         WEBHOOK_ERRORS_TOTAL.labels(reason="exception").inc()
-        return jsonify({"error": "Internal error"}), 500
+        return _json_response(_ERR_INTERNAL, 500)
+
+
+def _init_request_counters() -> None:
+    """Children REQUESTS_TOTAL для всех маршрутов заранее: в before_request — только dict.get."""
+    for rule in app.url_map.iter_rules():
+        if rule.rule in _UNCOUNTED_PATHS:
+            continue
+        for method in rule.methods or ():
+            _REQUEST_COUNTERS[(rule.rule, method)] = REQUESTS_TOTAL.labels(endpoint=rule.rule, method=method)
+    for method in ("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"):
+        _REQUEST_COUNTERS[("unknown", method)] = REQUESTS_TOTAL.labels(endpoint="unknown", method=method)
+
+
+_init_request_counters()
@@ -1,12 +1,103 @@
 # app/yookassa_manager.py
+import asyncio
+import functools
+import hashlib
 import logging
-from typing import Dict, Optional
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional, Tuple
+
+import orjson
 
 from yookassa import Configuration, Payment
 from app import storage
 
+try:
+    import httpx  # type: ignore
+except Exception:  # pragma: no cover
+    httpx = None
+
 logger = logging.getLogger(__name__)
 
+_API_BASE = "https://api.yookassa.ru/v3"
+_HTTP_TIMEOUT_S = 10.0
+_PAYMENT_ID_RE = re.compile(r"^[\w-]{1,64}$")  # id из вебхука подставляется в путь запроса
+
+
+@functools.lru_cache(maxsize=128)
+def _fmt_amount(cents: int) -> str:
+    """Сумма в копейках -> "299.00" (набор сумм маленький, строки переиспользуем)."""
+    return f"{cents / 100:.2f}"
+
+
+def _idempotence_key(user_id: int, kind: str, cents: int) -> str:
+    """
+    Один ключ на (пользователь, товар, сумма) в пределах минуты: повторный клик / ретрай
+    вернёт тот же платёж YooKassa вместо нового.
+    """
+    minute_bucket = int(time.time() // 60)
+    return hashlib.sha256(f"{user_id}:{kind}:{cents}:{minute_bucket}".encode()).hexdigest()[:32]
+
+
+# Недавно обработанные payment_id (в этом процессе): пачка ретраев YooKassa не ходит в Redis.
+# Только для уже начисленных платежей — занятый, но не завершённый claim сюда не попадает.
+_RECENT_MAX = 10000
+_RECENT_TTL_S = 300.0
+_recent: "OrderedDict[str, float]" = OrderedDict()
+_recent_lock = threading.Lock()
+
+
+def _recent_hit(payment_id: str) -> bool:
+    now = time.monotonic()
+    with _recent_lock:
+        ts = _recent.get(payment_id)
+        if ts is None:
+            return False
+        if now - ts > _RECENT_TTL_S:
+            del _recent[payment_id]
+            return False
+        _recent.move_to_end(payment_id)
+        return True
+
+
+def _remember(payment_id: str) -> None:
+    with _recent_lock:
+        _recent[payment_id] = time.monotonic()
+        _recent.move_to_end(payment_id)
+        while len(_recent) > _RECENT_MAX:
+            _recent.popitem(last=False)
+
+
+@functools.lru_cache(maxsize=8192)
+def _uid_str(user_id: int) -> str:
+    """user_id -> интернированная строка для metadata (пул пользователей небольшой и повторяется)."""
+    return sys.intern(str(user_id))
+
+
+@functools.lru_cache(maxsize=8192)
+def _uid_int(raw) -> int:
+    """metadata.user_id -> int; ValueError/TypeError как у int() (ошибки не кэшируются)."""
+    return int(raw)
+
+
+def _cents(amount: float) -> int:
+    # round(x, 2) округляет так же, как f"{x:.2f}" (12.345 -> 12.35), затем — в копейки
+    return round(round(amount, 2) * 100)
+
+
+@dataclass(slots=True)
+class CreateBody:
+    """Тело POST /payments; orjson сериализует dataclass сам (порядок полей = порядок в JSON)."""
+    amount: Dict[str, str]
+    capture: bool
+    confirmation: Dict[str, str]
+    description: str
+    metadata: Dict[str, str]
+
 
 class YooKassaManager:
     """
@@ -14,6 +105,8 @@ class YooKassaManager:
       - get_payment_url(user_id, amount?)        -> URL на оплату PRO
       - get_topup_url(user_id, minutes, amount)  -> URL на оплату докупки минут
       - async handle_webhook(payload)            -> Dict (idempotent)
+      - ack_webhook(payload)                     -> Dict: быстрые проверки + постановка в очередь
+      - async process_webhook_job(payload)       -> Dict: сверка статуса с API и начисление (в воркере)
     """
 
     def __init__(self, shop_id: str, secret_key: str, return_url: str, default_amount: float = 299.0):
@@ -21,20 +114,68 @@ class YooKassaManager:
         self.return_url = return_url or "https://t.me"
         Configuration.account_id = str(shop_id)
         Configuration.secret_key = str(secret_key)
+        self._auth = (str(shop_id), str(secret_key))
+        self._aclient = None  # httpx.AsyncClient: создаётся в loop вебхуков при первом запросе
+        self._client = None   # httpx.Client для создания платежей (вызовы из бота синхронные)
+        # Общая для всех платежей часть тела (только читается при сериализации)
+        self._confirmation = {"type": "redirect", "return_url": self.return_url}
         logger.info("✅ YooKassa configured")
 
+    def _get_aclient(self):
+        if self._aclient is None:
+            self._aclient = httpx.AsyncClient(
+                base_url=_API_BASE,
+                auth=self._auth,
+                timeout=_HTTP_TIMEOUT_S,
+                limits=httpx.Limits(max_keepalive_connections=32),
+            )
+        return self._aclient
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.Client(
+                base_url=_API_BASE,
+                auth=self._auth,
+                timeout=_HTTP_TIMEOUT_S,
+                limits=httpx.Limits(max_keepalive_connections=32),
+            )
+        return self._client
+
+    def _create_payment(self, body: CreateBody, idem_key: str) -> Optional[str]:
+        """POST /payments через пул соединений -> confirmation_url; без httpx — SDK."""
+        if httpx is None:
+            payment = Payment.create(asdict(body), idem_key)
+            conf = payment.confirmation
+            return conf.confirmation_url if conf else None
+        resp = self._get_client().post(
+            "/payments",
+            content=orjson.dumps(body),
+            headers={"Idempotence-Key": idem_key, "Content-Type": "application/json"},
+        )
+        resp.raise_for_status()
+        return (resp.json().get("confirmation") or {}).get("confirmation_url")
+
+    async def _find_payment(self, payment_id: str) -> Dict:
+        """GET /payments/{id} через пул соединений; без httpx — SDK в отдельном потоке."""
+        if httpx is None:
+            payment = await asyncio.to_thread(Payment.find_one, payment_id)
+            return {"status": getattr(payment, "status", None), "metadata": getattr(payment, "metadata", None)}
+        resp = await self._get_aclient().get(f"/payments/{payment_id}")
+        resp.raise_for_status()
+        return resp.json()
+
     # === PRO ===
     def get_payment_url(self, user_id: int, amount: Optional[float] = None) -> str:
         amt = float(amount if amount is not None else self.default_amount)
-        description = f"AI-Vera PRO for user {user_id}"
-        payment = Payment.create({
-            "amount": {"value": f"{amt:.2f}", "currency": "RUB"},
-            "capture": True,
-            "confirmation": {"type": "redirect", "return_url": self.return_url},
-            "description": description,
-            "metadata": {"user_id": str(user_id), "product": "AI-Vera PRO", "type": "pro"},
-        })
-        url = getattr(payment, "confirmation", None).confirmation_url
+        cents = _cents(amt)
+        body = CreateBody(
+            amount={"value": _fmt_amount(cents), "currency": "RUB"},
+            capture=True,
+            confirmation=self._confirmation,
+            description=f"AI-Vera PRO for user {user_id}",
+            metadata={"user_id": _uid_str(user_id), "product": "AI-Vera PRO", "type": "pro"},
+        )
+        url = self._create_payment(body, _idempotence_key(user_id, "pro", cents))
         if not url:
             raise RuntimeError("YooKassa: confirmation_url is empty")
         return url
@@ -43,76 +184,117 @@ class YooKassaManager:
     def get_topup_url(self, user_id: int, minutes: int, amount: float) -> str:
         amt = float(amount)
         mins = int(minutes)
-        description = f"AI-Vera Topup {mins}m for user {user_id}"
-        payment = Payment.create({
-            "amount": {"value": f"{amt:.2f}", "currency": "RUB"},
-            "capture": True,
-            "confirmation": {"type": "redirect", "return_url": self.return_url},
-            "description": description,
-            "metadata": {"user_id": str(user_id), "type": "topup", "minutes": str(mins)},
-        })
-        url = getattr(payment, "confirmation", None).confirmation_url
+        cents = _cents(amt)
+        body = CreateBody(
+            amount={"value": _fmt_amount(cents), "currency": "RUB"},
+            capture=True,
+            confirmation=self._confirmation,
+            description=f"AI-Vera Topup {mins}m for user {user_id}",
+            metadata={"user_id": _uid_str(user_id), "type": "topup", "minutes": str(mins)},
+        )
+        url = self._create_payment(body, _idempotence_key(user_id, f"topup:{mins}", cents))
         if not url:
             raise RuntimeError("YooKassa: confirmation_url is empty (topup)")
         return url
 
     # === Webhook ===
+    @staticmethod
+    def _check_webhook(payload: Dict, check_processed: bool = True) -> Tuple[Optional[str], Optional[Dict]]:
+        """(payment_id, None) — можно обрабатывать; (None, ответ) — нет/кривой id или дубль."""
+        obj = payload.get("object") or {}
+        payment_id = obj.get("id")
+        if not payment_id:
+            return None, {"success": False, "retryable": False, "error": "No payment id in webhook"}
+        if not _PAYMENT_ID_RE.match(str(payment_id)):
+            return None, {"success": False, "retryable": False, "error": "Invalid payment id in webhook"}
+        if _recent_hit(payment_id):
+            return None, {"success": True, "message": "already processed (local)"}
+        if check_processed and storage.is_payment_processed("yookassa", payment_id):
+            # без _remember: в Postgres processed_payments — это и незавершённый claim,
+            # который ещё могут отпустить; локально помним только начисленные (process_webhook_job)
+            logger.info("YooKassa: duplicate webhook ignored (%s)", payment_id)
+            return None, {"success": True, "message": "already processed"}
+        return payment_id, None
+
+    def ack_webhook(self, payload: Dict) -> Dict:
+        """Ответ вебхуку без похода в API: проверки и постановка в очередь (storage.enqueue_webhook_job)."""
+        try:
+            _, early = self._check_webhook(payload)
+            if early is not None:
+                return early
+            # не смогли поставить в Redis — не 2xx: пусть YooKassa повторит вебхук
+            if not storage.enqueue_webhook_job("yookassa", payload):
+                return {"success": False, "error": "webhook queue unavailable"}
+            return {"success": True, "queued": True}
+        except Exception as e:
+            logger.exception("YooKassa webhook ack error")
+            return {"success": False, "error": str(e)}
+
     async def handle_webhook(self, payload: Dict) -> Dict:
+        """Синхронная (без очереди) обработка webhook — то же, что process_webhook_job."""
+        return await self.process_webhook_job(payload)
+
+    async def process_webhook_job(self, payload: Dict) -> Dict:
         """
         Идемпотентная обработка webhook:
-          • проверяем payment_id
+          • проверяем payment_id и атомарно занимаем его (storage.claim_payment)
           • уточняем статус через API
-          • применяем PRO / TOPUP
+          • применяем PRO / TOPUP; если начисления не было — отпускаем claim
+        Ошибки, которые повтор не исправит, помечены "retryable": False.
         """
+        payment_id = None
+        claimed = granted = False
         try:
             obj = payload.get("object") or {}
-            payment_id = obj.get("id")
-            if not payment_id:
-                return {"success": False, "error": "No payment id in webhook"}
+            payment_id, early = self._check_webhook(payload, check_processed=False)
+            if early is not None:
+                return early
 
-            if storage.is_payment_processed("yookassa", payment_id):
+            # claim ДО похода в API: параллельные ретраи того же платежа до YooKassa не доходят
+            if not storage.claim_payment("yookassa", payment_id):
                 logger.info("YooKassa: duplicate webhook ignored (%s)", payment_id)
                 return {"success": True, "message": "already processed"}
+            claimed = True
 
-            payment = Payment.find_one(payment_id)
-            status = getattr(payment, "status", None)
+            # статус уточняем через API (не доверяем телу вебхука)
+            payment = await self._find_payment(payment_id)
+            status = payment.get("status")
 
             # metadata (из API приоритезируем; если нет — берём из payload.object.metadata)
-            meta = {}
-            try:
-                meta = payment.metadata or {}
-            except Exception:
-                meta = {}
+            meta = payment.get("metadata") or {}
             if not meta:
                 meta = obj.get("metadata") or {}
 
             user_id_raw = meta.get("user_id")
+            # без user_id начислять некому, повтор не поможет (например, платёж создан в кабинете)
             if not user_id_raw:
-                return {"success": False, "error": "No user_id in metadata"}
+                return {"success": False, "retryable": False, "error": "No user_id in metadata"}
             try:
-                user_id = int(user_id_raw)
+                user_id = _uid_int(user_id_raw)
             except Exception:
-                return {"success": False, "error": "Invalid user_id in metadata"}
+                return {"success": False, "retryable": False, "error": "Invalid user_id in metadata"}
 
             pay_type = str(meta.get("type") or "").lower()
 
             if status == "succeeded":
-                # помечаем как обработанный ДО побочных действий
-                storage.mark_payment_processed("yookassa", payment_id)
-
+                # отметка «обработан» и начисление — одной записью в хранилище
                 if pay_type == "topup":
                     try:
                         minutes = int(meta.get("minutes") or "0")
                     except Exception:
                         minutes = 0
                     if minutes > 0:
-                        storage.add_overage_seconds(user_id, minutes * 60)
+                        storage.apply_grant("yookassa", payment_id, user_id, "topup", minutes * 60)
+                        granted = True
                         logger.info("YooKassa: user %s TOPUP +%sm (payment %s)", user_id, minutes, payment_id)
                         return {"success": True, "message": f"user {user_id} topped up {minutes}m"}
+                    storage.mark_payment_processed("yookassa", payment_id)
+                    granted = True
                     return {"success": True, "message": "topup succeeded, but minutes=0"}
 
                 # default: PRO
-                storage.add_pro(user_id)
+                storage.apply_grant("yookassa", payment_id, user_id, "pro")
+                granted = True
                 logger.info("YooKassa: user %s upgraded to PRO (payment %s)", user_id, payment_id)
                 return {"success": True, "message": f"user {user_id} upgraded to PRO"}
 
@@ -127,3 +309,8 @@ class YooKassaManager:
         except Exception as e:
             logger.exception("YooKassa webhook error")
             return {"success": False, "error": str(e)}
+        finally:
+            if granted:
+                _remember(payment_id)
+            elif claimed:
+                storage.release_payment_claim("yookassa", payment_id)
@@ -0,0 +1,8 @@
+# gunicorn.conf.py — хуки gunicorn для web-сервиса (render.yaml: gunicorn -c gunicorn.conf.py ...)
+
+
+def post_worker_init(worker):
+    # Потребитель очереди вебхуков стартует вместе с воркером, а не с первым вебхуком:
+    # задания, оставшиеся в Redis после рестарта, не ждут следующей оплаты
+    from app.web import ensure_job_worker
+    ensure_job_worker()
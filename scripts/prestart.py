@@ -0,0 +1,24 @@
+# scripts/prestart.py
+"""
+Разовые шаги перед запуском сервисов (один раз на деплой, а не в каждом воркере):
+    python scripts/prestart.py && exec gunicorn ... app.web:app
+Сейчас — миграция PRO_USER_IDS (app.bootstrap.run_startup_migrations).
+"""
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import LOG_LEVEL  # noqa: E402
+from app.bootstrap import run_startup_migrations  # noqa: E402
+
+
+def main() -> int:
+    logging.basicConfig(level=getattr(logging, str(LOG_LEVEL).upper(), logging.INFO))
+    run_startup_migrations()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import pytest
+
+from app import storage
+
+
+@pytest.fixture
+def mem_storage(monkeypatch):
+    monkeypatch.setattr(storage, "_redis", None)
+    monkeypatch.setattr(storage, "_pg_conn", None)
+    monkeypatch.setattr(storage, "_mem_claims", {})
+    monkeypatch.setattr(storage, "_mem_processed", set())
+    monkeypatch.setattr(storage, "_mem_pro", set())
+    return storage
+
+
+@pytest.fixture
+def redis_storage(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(storage, "_redis", fakeredis.FakeRedis(decode_responses=True))
+    monkeypatch.setattr(storage, "_pg_conn", None)
+    monkeypatch.setattr(storage, "_scripts", {})
+    return storage
+
+
+def test_claim_is_exclusive_until_released(mem_storage):
+    assert mem_storage.claim_payment("yookassa", "p1")
+    assert not mem_storage.claim_payment("yookassa", "p1")
+    mem_storage.release_payment_claim("yookassa", "p1")
+    assert mem_storage.claim_payment("yookassa", "p1")
+
+
+def test_claim_expires_after_crash(mem_storage, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(storage.time, "monotonic", lambda: now[0])
+    assert mem_storage.claim_payment("yookassa", "p1")
+    # процесс умер до apply_grant / release_payment_claim
+    now[0] += mem_storage.PAYMENT_CLAIM_TTL_S + 1
+    assert mem_storage.claim_payment("yookassa", "p1")
+
+
+def test_claim_refused_after_grant(mem_storage, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(storage.time, "monotonic", lambda: now[0])
+    assert mem_storage.claim_payment("yookassa", "p1")
+    mem_storage.apply_grant("yookassa", "p1", 42, "pro")
+    now[0] += mem_storage.PAYMENT_CLAIM_TTL_S + 1
+    assert not mem_storage.claim_payment("yookassa", "p1")
+
+
+def test_redis_claim_is_short_lived(redis_storage):
+    r = redis_storage._redis
+    assert redis_storage.claim_payment("yookassa", "p1")
+    assert not redis_storage.claim_payment("yookassa", "p1")
+    assert 0 < r.ttl("pc:yookassa:p1") <= redis_storage.PAYMENT_CLAIM_TTL_S
+    # процесс умер, claim истёк — повтор задания снова может начислить
+    r.delete("pc:yookassa:p1")
+    assert redis_storage.claim_payment("yookassa", "p1")
+
+
+def test_redis_claim_refused_for_processed_payment(redis_storage):
+    redis_storage._redis.sadd("pp:yookassa", "old")
+    assert not redis_storage.claim_payment("yookassa", "old")
+
+    assert redis_storage.claim_payment("yookassa", "p2")
+    redis_storage.apply_grant("yookassa", "p2", 42, "pro")
+    assert not redis_storage._redis.exists("pc:yookassa:p2")
+    assert not redis_storage.claim_payment("yookassa", "p2")
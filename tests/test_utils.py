@@ -0,0 +1,22 @@
+from app.utils import classify_file, format_seconds
+
+
+def test_classify_file_by_extension():
+    assert classify_file("voice.MP3") == "audio"
+    assert classify_file("clip.final.webm") == "video"
+    assert classify_file("notes.txt") is None
+
+
+def test_classify_file_without_extension():
+    assert classify_file("mp3") is None
+    assert classify_file(".mp3") is None
+    assert classify_file("dir/.mp4") is None
+
+
+def test_format_seconds_zero():
+    assert format_seconds(0) == "0:00:00"
+
+
+def test_format_seconds_over_a_day():
+    assert format_seconds(61) == "0:01:01"
+    assert format_seconds(25 * 3600) == "25:00:00"